@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from threading import Thread
+from uuid import uuid4
+
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+
+from .bbb import AsyncClient, client, forget
+from .collect import Gauges
+
+
+log = logging.getLogger(__name__)
+
+
+# getMeetings, the meeting round trip and the HTML5 client run concurrently
+CALLS_PER_PROBE = 3
+
+
+async def probe_api(api, hostname):
+    """Check a server using its API and a plain fetch of the HTML5 client only."""
+    registry = CollectorRegistry(auto_describe=True)
+
+    labelnames = ['backend']
+    labelvalues = (hostname)
+
+    def make_gauges(slug, description):
+        success = Gauge(f'api_{slug}_success', f'Success of {description}', labelnames, registry=registry).labels(labelvalues)
+        success.set(False)
+        duration = Gauge(f'api_{slug}_duration_seconds', f'Duration of {description}', labelnames, registry=registry).labels(labelvalues)
+        duration.set(0)
+        return Gauges(success, duration)
+
+    async def check(gauges, call):
+        with gauges.duration.time():
+            try:
+                await call
+                gauges.success.set(True)
+                return True
+            except Exception as exc:
+                log.debug(exc, exc_info=True)
+                return False
+
+    get_meetings = make_gauges('get_meetings', 'listing meetings via API')
+    create = make_gauges('create', 'creating a meeting via API')
+    is_meeting_running = make_gauges('is_meeting_running', 'querying a meeting via API')
+    end = make_gauges('end', 'ending a meeting via API')
+    html5client = make_gauges('html5client', 'fetching the HTML5 client')
+
+    async def meeting_round_trip():
+        meeting_id = str(uuid4())
+        moderator_pw = str(uuid4())
+        if not await check(create, api.call('create', {'meetingID': meeting_id, 'moderatorPW': moderator_pw})):
+            return
+        await check(is_meeting_running, api.call('isMeetingRunning', {'meetingID': meeting_id}))
+        await check(end, api.call('end', {'meetingID': meeting_id, 'password': moderator_pw}))
+
+    await asyncio.gather(
+        check(get_meetings, api.call('getMeetings', {})),
+        meeting_round_trip(),
+        check(html5client, api.fetch('/html5client/')),
+    )
+    return registry
+
+
+class ApiProber():
+    """Runs the cheap API probes of all targets in an asyncio loop of its own.
+
+    Each target is probed every interval at a fixed phase derived from its
+    host name, with at most concurrency probes running at the same time.
+    The rendered results are handed to publish(host, payload).
+    """
+
+    def __init__(self, interval, concurrency, publish, client_options=None):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.publish = publish
+        self.client_options = client_options or dict()
+        self._targets = dict()
+        self._tasks = dict()
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency * CALLS_PER_PROBE, thread_name_prefix='bbb-api')
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def update_targets(self, targets):
+        self._loop.call_soon_threadsafe(self._update_targets, list(targets))
+
+    def _update_targets(self, targets):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        # running probes pick up changed secrets with their next round
+        self._targets = {target.host: target for target in targets}
+        for host in set(self._tasks) - set(self._targets):
+            self._tasks.pop(host).cancel()
+            forget(host)
+        for host in set(self._targets) - set(self._tasks):
+            self._tasks[host] = self._loop.create_task(self._probe_forever(host))
+
+    async def _probe_forever(self, host):
+        phase = int(sha1(host.encode()).hexdigest(), 16) % int(self.interval * 1000) / 1000
+        await asyncio.sleep(phase)
+        while True:
+            start = self._loop.time()
+            try:
+                target = self._targets[host]
+                api = AsyncClient(client(target.host, target.secret, **self.client_options), self._executor)
+                async with self._semaphore:
+                    registry = await probe_api(api, host)
+                self.publish(host, generate_latest(registry))
+            except Exception as exc:
+                log.exception(exc)
+            await asyncio.sleep(max(0, self.interval - (self._loop.time() - start)))
+
+    async def _cancel_all(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown()
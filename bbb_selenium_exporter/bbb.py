@@ -1,10 +1,28 @@
+import asyncio
+import functools
+import os
+import time
 from collections import OrderedDict
 from hashlib import sha1
+from threading import Lock
 from urllib.parse import urlencode
 from uuid import uuid4
 import xml.etree.ElementTree as ET
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from . import telemetry
+
+
+API_TIMEOUT = 5
+API_RETRIES = 2
+API_BACKOFF = 0.2
+POOL_MAXSIZE = 8
+
+API_LATENCY = telemetry.histogram('bbb_api_request_duration_seconds', 'Duration of BBB API calls', ['call'],
+                                  buckets=(0.0001, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')))
+API_RETRIES_TOTAL = telemetry.counter('bbb_api_retries_total', 'BBB API calls retried after a connection error', ['call'])
 
 
 class Error(Exception):
@@ -12,10 +30,139 @@ class Error(Exception):
     pass
 
 
-class Meeting():
-    def __init__(self, hostname, secret, name=None):
-        self._hostname = hostname
+class Client():
+    """Talks to the API of one BBB server, keeping its connections alive between calls.
+
+    The scheme is only ever changed to reach a local fake server.
+    """
+
+    def __init__(self, hostname, secret, timeout=API_TIMEOUT, retries=API_RETRIES, backoff=API_BACKOFF, scheme='https'):
+        self.hostname = hostname
         self._secret = secret
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.scheme = scheme
+        self._session = requests.Session()
+        self._session.mount(f'{scheme}://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE))
+
+    def call(self, method, params):
+        """Call an API method and return the parsed XML response if it succeeded."""
+        url = self.build_url(method, params)
+        with API_LATENCY.labels(method).time():
+            response = self._get(method, url)
+        try:
+            root = ET.fromstring(response.content)
+        except ET.ParseError as exc:
+            raise Error('failed to parse server response') from exc
+
+        returncode = root.findtext('returncode')
+        if returncode is None:
+            raise Error('received XML response with missing keys')
+        if returncode == 'SUCCESS':
+            return root
+        message_key = root.findtext('messageKey')
+        message = root.findtext('message')
+        if message_key is None or message is None:
+            raise Error('received XML response with missing keys')
+        raise Error(f'{message_key}: {message}')
+
+    def fetch(self, path):
+        """Fetch a page from the server outside of the API, e.g. the HTML5 client."""
+        response = self._get('fetch', f'{self.scheme}://{self.hostname}{path}')
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as exc:
+            raise Error(f'failed to fetch {path}') from exc
+        return response
+
+    def _get(self, method, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return self._session.get(url, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+                if attempt == self.retries:
+                    raise Error('failed to talk to server') from exc
+                API_RETRIES_TOTAL.labels(method).inc()
+                time.sleep(self.backoff * 2 ** attempt)
+            except requests.exceptions.RequestException as exc:
+                raise Error('failed to talk to server') from exc
+
+    def build_url(self, method, params):
+        params = OrderedDict(params)
+        params['checksum'] = self.checksum(method, params)
+        return f'{self.scheme}://{self.hostname}/bigbluebutton/api/{method}?{urlencode(params)}'
+
+    def checksum(self, method, params):
+        return sha1(f'{method}{urlencode(params)}{self._secret}'.encode()).hexdigest()
+
+    def close(self):
+        self._session.close()
+
+
+_clients = dict()
+_clients_lock = Lock()
+
+
+def _forget_clients():
+    # Worker processes are forked from the exporter, whose threads may be
+    # using the clients right then. Their connections stay with the parent,
+    # so the child starts over with clients of its own.
+    global _clients, _clients_lock
+    _clients = dict()
+    _clients_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+def client(hostname, secret, **options):
+    """Return the shared client of a server, creating it on first use.
+
+    A changed secret is taken over by the existing client, keeping its
+    connections.
+    """
+    key = (hostname, tuple(sorted(options.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = Client(hostname, secret, **options)
+        _clients[key]._secret = secret
+        return _clients[key]
+
+
+def forget(hostname):
+    """Close the clients of a server that is not probed anymore."""
+    with _clients_lock:
+        dropped = [_clients.pop(key) for key in list(_clients) if key[0] == hostname]
+    for dropped_client in dropped:
+        dropped_client.close()
+
+
+class AsyncClient():
+    """Asyncio front end of a Client.
+
+    The blocking calls run in the given thread pool, which is shared by all
+    async clients of a loop, so the pooled connections of the Client are
+    reused. It needs a thread for every concurrent call, or calls would
+    queue for a thread instead of the server.
+    """
+
+    def __init__(self, client, executor):
+        self.client = client
+        self.executor = executor
+
+    async def call(self, method, params):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self.client.call, method, params))
+
+    async def fetch(self, path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.client.fetch, path)
+
+
+class Meeting():
+    def __init__(self, hostname, secret, name=None, **client_options):
+        self._client = client(hostname, secret, **client_options)
         self._meeting_id = name or str(uuid4())
         self._moderator_pw = str(uuid4())
 
@@ -27,36 +174,19 @@ class Meeting():
         self._api_call('end', {'meetingID': self._meeting_id, 'password': self._moderator_pw})
 
     def _api_call(self, method, params):
-        try:
-            response = requests.get(self._build_url(method, params), timeout=0.5)
-            root = ET.fromstring(response.text)
-            if root.findall('returncode')[0].text == 'SUCCESS':
-                return
-            message_key = root.findall('messageKey')[0].text
-            message = root.findall('message')[0].text
-            raise Error(f'{message_key}: {message}')
-        except requests.exceptions.RequestException as exc:
-            raise Error('failed to talk to server') from exc
-        except ET.ParseError as exc:
-            raise Error('failed to parse server response') from exc
-        except IndexError as exc:
-            raise Error('received XML response with missing keys') from exc
+        self._client.call(method, params)
 
     def _build_url(self, method, params):
-        params = OrderedDict(params)
-        params['checksum'] = self._checksum(method, params)
-        return f'https://{self._hostname}/bigbluebutton/api/{method}?{urlencode(params)}'
-
-    def _checksum(self, method, params):
-        return sha1(f'{method}{urlencode(params)}{self._secret}'.encode()).hexdigest()
+        return self._client.build_url(method, params)
 
     def join_url(self, username):
-        return self._build_url('join', {
-            'meetingID': self._meeting_id,
-            'password': self._moderator_pw,
-            'fullName': username,
-            'redirect': 'true',
-            'userdata-bbb_auto_swap_layout': 'false',
-            'userdata-bbb_auto_share_webcam': 'false',
-            'userdata-bbb_show_public_chat_on_login': 'true'
-        })
+        with API_LATENCY.labels('join').time():
+            return self._build_url('join', {
+                'meetingID': self._meeting_id,
+                'password': self._moderator_pw,
+                'fullName': username,
+                'redirect': 'true',
+                'userdata-bbb_auto_swap_layout': 'false',
+                'userdata-bbb_auto_share_webcam': 'false',
+                'userdata-bbb_show_public_chat_on_login': 'true'
+            })
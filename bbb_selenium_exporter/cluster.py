@@ -0,0 +1,103 @@
+from hashlib import sha1
+from threading import Event, Lock, Thread
+
+import requests
+from prometheus_client import Gauge
+
+
+FORWARDED_HEADER = 'X-BBB-Exporter-Forwarded'
+HEALTH_PATH = '/-/healthy'
+HEALTH_TIMEOUT = 2
+PROXY_TIMEOUT = 10
+
+CLUSTER_NODES_UP = Gauge('cluster_nodes_up', 'Cluster nodes currently considered alive')
+CLUSTER_OWNED_TARGETS = Gauge('cluster_owned_targets', 'Targets probed by this node')
+
+
+def owner(host, nodes):
+    """Pick the node owning a host by rendezvous hashing.
+
+    Only the hosts of a node that joins or leaves move to another node.
+    """
+    return max(nodes, key=lambda node: sha1(f'{node} {host}'.encode()).digest())
+
+
+class Cluster():
+    """Shards the targets among several exporter nodes sharing one targets file.
+
+    Every node knows the addresses of all nodes, checks their health regularly
+    and probes only the targets it owns among the alive nodes. Whenever a node
+    joins or leaves, on_change is called with the newly owned targets.
+    """
+
+    def __init__(self, me, nodes, on_change, check_interval=5):
+        self.me = me
+        self.nodes = sorted(set(nodes) | {me})
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self._alive = {me}
+        self._targets = []
+        self._lock = Lock()
+        self._rebalance_lock = Lock()
+        self._stopped = Event()
+        self._session = requests.Session()
+        self._check()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def owner(self, host):
+        with self._lock:
+            return owner(host, self._alive)
+
+    def peers(self):
+        """The other nodes currently alive."""
+        with self._lock:
+            return sorted(self._alive - {self.me})
+
+    def update_targets(self, targets):
+        with self._lock:
+            self._targets = list(targets)
+        self._rebalance()
+
+    def _rebalance(self):
+        with self._rebalance_lock:
+            with self._lock:
+                owned = [target for target in self._targets if owner(target.host, self._alive) == self.me]
+            CLUSTER_OWNED_TARGETS.set(len(owned))
+            self.on_change(owned)
+
+    def proxy(self, node, path, if_none_match=None, accept_encoding=None):
+        headers = {FORWARDED_HEADER: self.me}
+        if if_none_match:
+            headers['If-None-Match'] = if_none_match
+        if accept_encoding:
+            # the owner tags its response for the coding the client gets in the end
+            headers['Accept-Encoding'] = accept_encoding
+        return self._session.get(f'http://{node}{path}', headers=headers, timeout=PROXY_TIMEOUT)
+
+    def _is_alive(self, node):
+        if node == self.me:
+            return True
+        try:
+            return self._session.get(f'http://{node}{HEALTH_PATH}', timeout=HEALTH_TIMEOUT).ok
+        except requests.exceptions.RequestException:
+            return False
+
+    def _check(self):
+        alive = {node for node in self.nodes if self._is_alive(node)}
+        CLUSTER_NODES_UP.set(len(alive))
+        with self._lock:
+            changed = alive != self._alive
+            self._alive = alive
+        if changed:
+            print(f'cluster nodes alive: {", ".join(sorted(alive))}')
+        return changed
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            if self._check():
+                self._rebalance()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
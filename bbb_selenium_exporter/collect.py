@@ -1,19 +1,31 @@
+import functools
 import logging
+import math
+import os
+import random
+import shutil
+import tempfile
 import time
 import uuid
-from contextlib import contextmanager
-from tempfile import NamedTemporaryFile
-from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+from io import BytesIO
+from collections import OrderedDict, deque, namedtuple
+from threading import Event, Lock, Thread
 
 import pkg_resources
 from PIL import Image
-from prometheus_client import CollectorRegistry, Gauge
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
 from selenium import webdriver
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from selenium.common.exceptions import (JavascriptException, NoSuchElementException, StaleElementReferenceException, TimeoutException,
+                                        WebDriverException)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.support.wait import WebDriverWait
 
+from . import proc, spans, telemetry
+from . import bbb
 from .bbb import Meeting
 
 
@@ -23,120 +35,737 @@ log = logging.getLogger(__name__)
 SELENIUM_TIMEOUT = 20
 SHORT_TIMEOUT = 10
 NEXT_TRY_TIMEOUT = 5
-MAX_TRIES = 20
+PIXEL_TIMEOUT = 20
+PIXEL_POLL_INTERVAL = 0.2
+BUDGET_SAMPLES = 10
+BUDGET_MIN_SAMPLES = 3
+BUDGET_FLOOR = 5
+
+PIXEL_MODES = ('canvas', 'screenshot')
+WAIT_MODES = ('observer', 'poll')
+LAUNCH_PROFILES = ('default', 'dense')
+
+# The dense launch profile trades fidelity of the browser for running many of
+# them on one machine: no background services, few renderer processes, a
+# small window, a small disk cache and a camera producing few frames.
+DENSE_CHROME_ARGUMENTS = (
+    '--disable-background-networking',
+    '--disable-breakpad',
+    '--disable-client-side-phishing-detection',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-domain-reliability',
+    '--disable-extensions',
+    '--disable-features=Translate,OptimizationHints,MediaRouter,AutofillServerCommunication,CertificateTransparencyComponentUpdater',
+    '--disable-gpu',
+    '--disable-sync',
+    '--metrics-recording-only',
+    '--mute-audio',
+    '--no-default-browser-check',
+    '--no-first-run',
+    '--renderer-process-limit=2',
+    '--window-size=1024,768',
+    f'--disk-cache-size={32 * 2**20}',
+)
+DENSE_CAMERA = 'fps=5'
+CAMERA_QUALITY = {'default': 'medium', 'dense': 'low'}
+
+SCENARIOS = ('connect_server', 'echo_test', 'join_headphone', 'start_cam', 'upload_pres', 'chat_test', 'poll_test', 'etherpad_test')
+SCENARIO_DESCRIPTIONS = {
+    'connect_server': 'connecting to BBB server',
+    'echo_test': 'waiting for echo test',
+    'join_headphone': 'joining room with headphones',
+    'start_cam': 'starting camera',
+    'upload_pres': 'uploading presentation',
+    'chat_test': 'testing chat',
+    'poll_test': 'testing poll',
+    'etherpad_test': 'testing etherpad',
+}
+
+Profile = namedtuple('Profile', ['name', 'scenarios'])
+
+PROFILES = {
+    'full': Profile('full', SCENARIOS),
+    'light': Profile('light', ('connect_server', 'echo_test', 'chat_test')),
+}
+# reported for probes that only re-verified a live meeting
+LIVE_PROFILE = Profile('live', ())
+# a full probe can only be followed by live checks if these succeeded
+LIVE_SCENARIOS = ('start_cam', 'chat_test')
+
+# What a failed scenario tells about the server, from worst to mildest. After
+# an unreachable server or a client that didn't load no scenario can succeed.
+# Audio and video are independent, so a media failure only affects the
+# scenarios requiring the failed one.
+FAILURE_KINDS = ('unreachable', 'client', 'media', 'feature')
+FATAL_FAILURES = ('unreachable', 'client')
+
+# One way to find an element of the BBB client, named after its strategy.
+Variant = namedtuple('Variant', ['name', 'by', 'value'])
+
+# The elements of the BBB client the probes wait for. Hashed CSS module
+# classes change with every release of the client, so every element comes
+# with fallbacks, from the most to the least stable. All variants of an
+# element are looked for at once, the first one found wins.
+SELECTORS = {
+    'microphone': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Microphone']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='microphoneBtn']"),
+        Variant('class', By.CSS_SELECTOR, ".audioBtn--1H6rCK"),
+    ),
+    'echo_yes': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Echo is audible']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='echoYesBtn']"),
+        Variant('class', By.CSS_SELECTOR, ".button--1JElwW"),
+    ),
+    'listen_only': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Listen only']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='listenOnlyBtn']"),
+        Variant('class', By.CSS_SELECTOR, ".icon-bbb-listen"),
+    ),
+    'close_audio': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Close Join audio modal']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='modalBaseCloseButton']"),
+    ),
+    'actions': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Actions']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='actionsButton']"),
+        Variant('class', By.CSS_SELECTOR, ".button--ZzeTUF"),
+    ),
+    'upload_menu': (
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='uploadPresentation']"),
+        Variant('text', By.XPATH, "//span[text()='Upload a presentation']"),
+    ),
+    'upload_confirm': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Upload ']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='confirmManagePresentation']"),
+    ),
+    'presentation': (
+        Variant('data-test', By.CSS_SELECTOR, "svg[data-test='whiteboard']"),
+        Variant('class', By.CSS_SELECTOR, ".svgContainer--Z1z3wO0"),
+    ),
+    'share_webcam': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Share webcam']"),
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='joinVideo']"),
+    ),
+    'start_sharing': (
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='startSharingWebcam']"),
+        Variant('class', By.CSS_SELECTOR, ".primary--1IbqAO > .label--Z12LMR3:nth-child(1)"),
+    ),
+    'webcam': (
+        Variant('data-test', By.CSS_SELECTOR, "video[data-test='videoContainer']"),
+        Variant('class', By.CSS_SELECTOR, ".cursorGrab--Z2fB4yK"),
+    ),
+    'chat_input': (
+        Variant('id', By.CSS_SELECTOR, "#message-input"),
+        Variant('class', By.CSS_SELECTOR, ".input--2wilPX"),
+    ),
+    'chat_messages': (
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='chatMessages']"),
+        Variant('class', By.CSS_SELECTOR, ".content--Z2nhld9"),
+    ),
+    'poll_menu': (
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='polling']"),
+        Variant('text', By.XPATH, "//span[text()='Start a poll']"),
+    ),
+    'poll_yes_no': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Yes / No']"),
+    ),
+    'poll_answer_yes': (
+        Variant('aria', By.CSS_SELECTOR, "button[aria-label='Yes']"),
+    ),
+    'notes': (
+        Variant('data-test', By.CSS_SELECTOR, "[data-test='sharedNotes']"),
+        Variant('class', By.CSS_SELECTOR, ".listItem--Siv4F"),
+    ),
+    'notes_panel': (
+        Variant('class', By.CSS_SELECTOR, ".note--1ESx6q"),
+    ),
+    'notes_pad': (
+        Variant('class', By.CSS_SELECTOR, ".userlistPad--o5KDX"),
+    ),
+}
+
+POOL_HITS = telemetry.counter('driver_pool_hits_total', 'Probes served by a pre-launched browser session')
+POOL_COLD_STARTS = telemetry.counter('driver_pool_cold_starts_total', 'Probes that had to launch a new browser session')
+POOL_RECYCLES = telemetry.counter('driver_pool_recycles_total', 'Browser sessions retired from the pool', ['reason'])
+SCENARIO_FAILURES = telemetry.counter('probe_scenario_failures_total', 'Failed scenarios by kind of failure', ['kind'])
+SCENARIO_SKIPS = telemetry.counter('probe_scenarios_skipped_total', 'Scenarios skipped because an earlier failure kept them from succeeding',
+                                   ['cause'])
+LIVE_REUSES = telemetry.counter('live_meeting_reuses_total', 'Probes that re-verified a meeting kept alive instead of creating one')
+LIVE_ENDED = telemetry.counter('live_meetings_ended_total', 'Meetings kept alive between probes that were ended', ['reason'])
+LIVE_SECONDS_SAVED = telemetry.counter('live_probe_seconds_saved_total',
+                                       'Probe time saved by re-verifying meetings kept alive compared to the full probe that created them')
+
+# Draws the video or image inside the element matching arguments[0] into a
+# canvas laid out like the element and resolves as soon as the sampled pixel
+# lies within the given color bounds.
+PIXEL_SCRIPT = '''
+const [selector, point, lower, upper, timeout, done] = arguments;
+const deadline = performance.now() + timeout * 1000;
+const canvas = document.createElement('canvas');
+const context = canvas.getContext('2d', {willReadFrequently: true});
+const images = new Map();
+
+function source(element) {
+    const video = element.tagName === 'VIDEO' ? element : element.querySelector('video');
+    if (video) {
+        return video.readyState >= 2 ? [video, video] : null;
+    }
+    const image = element.querySelector('image, img');
+    if (!image) {
+        throw new Error('no video or image found');
+    }
+    const href = image.getAttribute('href') || image.getAttribute('xlink:href') || image.src;
+    if (!images.has(href)) {
+        const img = new Image();
+        img.src = href;
+        images.set(href, img);
+    }
+    const img = images.get(href);
+    return img.complete && img.naturalWidth ? [img, image] : null;
+}
+
+function sample() {
+    const element = document.querySelector(selector);
+    if (!element) {
+        return null;
+    }
+    const found = source(element);
+    if (!found) {
+        return null;
+    }
+    const box = element.getBoundingClientRect();
+    const drawn = found[1].getBoundingClientRect();
+    canvas.width = Math.max(1, Math.round(box.width));
+    canvas.height = Math.max(1, Math.round(box.height));
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    context.drawImage(found[0], drawn.left - box.left, drawn.top - box.top, drawn.width, drawn.height);
+    const [x, y] = point || [canvas.width / 2, canvas.height / 2];
+    return Array.from(context.getImageData(Math.floor(x), Math.floor(y), 1, 1).data.slice(0, 3));
+}
+
+function poll() {
+    let pixel;
+    try {
+        pixel = sample();
+    } catch (error) {
+        done({error: String(error)});
+        return;
+    }
+    if (pixel && pixel.every((value, i) => lower[i] <= value && value <= upper[i])) {
+        done({pixel: pixel});
+    } else if (performance.now() > deadline) {
+        done({pixel: pixel});
+    } else {
+        setTimeout(poll, 50);
+    }
+}
+
+poll();
+'''
+
+# Resolves as soon as every condition [variants, state] in arguments[0]
+# holds, re-checking whenever the document changes, or after the timeout
+# with the indexes of the conditions still pending. A condition holds if the
+# element of any of its [by, value] variants is in the state, invisible ones
+# only if none is visible. The element and the index of the variant found
+# are returned for every condition, null for invisible ones, together with
+# the version of the BBB client if the page tells it.
+WAIT_SCRIPT = '''
+const [conditions, timeout, done] = arguments;
+let observer, timer, frame, cancelFrame, finished = false;
+
+function clientVersion() {
+    const settings = window.meetingClientSettings || (window.Meteor && window.Meteor.settings);
+    const app = settings && settings.public && settings.public.app;
+    return app ? String(app.bbbServerVersion || app.html5ClientBuild || '') || null : null;
+}
+
+function find(by, value) {
+    switch (by) {
+    case 'css selector':
+        return document.querySelector(value);
+    case 'xpath':
+        return document.evaluate(value, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    case 'id':
+        return document.getElementById(value);
+    case 'tag name':
+        return document.getElementsByTagName(value)[0] || null;
+    }
+    throw new Error('unsupported selector ' + by);
+}
+
+function visible(element) {
+    if (!element.isConnected || !element.getClientRects().length) {
+        return false;
+    }
+    const style = getComputedStyle(element);
+    return style.visibility !== 'hidden' && style.opacity !== '0';
+}
+
+function holds(element, state) {
+    switch (state) {
+    case 'present':
+        return Boolean(element);
+    case 'visible':
+        return Boolean(element) && visible(element);
+    case 'clickable':
+        return Boolean(element) && visible(element) && !element.disabled;
+    case 'invisible':
+        return !element || !visible(element);
+    }
+    throw new Error('unsupported state ' + state);
+}
+
+function check([variants, state]) {
+    const elements = variants.map(([by, value]) => find(by, value));
+    if (state === 'invisible') {
+        return elements.every(element => holds(element, state)) ? [null, null] : null;
+    }
+    const index = elements.findIndex(element => holds(element, state));
+    return index >= 0 ? [elements[index], index] : null;
+}
+
+function finish(result) {
+    // Waits run again and again on the same page, so nothing of this one
+    // may stay behind, and a late check must not resolve it twice.
+    if (finished) {
+        return;
+    }
+    finished = true;
+    observer.disconnect();
+    document.removeEventListener('transitionend', schedule, true);
+    document.removeEventListener('animationend', schedule, true);
+    clearTimeout(timer);
+    if (frame != null) {
+        cancelFrame(frame);
+    }
+    done(result);
+}
+
+function evaluate() {
+    frame = null;
+    if (finished) {
+        return;
+    }
+    let results;
+    try {
+        results = conditions.map(check);
+    } catch (error) {
+        finish({error: String(error)});
+        return;
+    }
+    if (results.every(result => result)) {
+        finish({elements: results.map(result => result[0]), variants: results.map(result => result[1]), version: clientVersion()});
+    }
+}
+
+function schedule() {
+    // Coalesce bursts of mutations into one check per frame. Animation
+    // frames do not fire in background windows, so fall back to a timer.
+    if (finished || frame != null) {
+        return;
+    }
+    if (document.hidden) {
+        frame = setTimeout(evaluate, 0);
+        cancelFrame = clearTimeout;
+    } else {
+        frame = requestAnimationFrame(evaluate);
+        cancelFrame = cancelAnimationFrame;
+    }
+}
+
+observer = new MutationObserver(schedule);
+observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+// CSS transitions change visibility without touching the DOM.
+document.addEventListener('transitionend', schedule, true);
+document.addEventListener('animationend', schedule, true);
+timer = setTimeout(() => finish({pending: conditions.map((condition, i) => check(condition) ? null : i).filter(i => i !== null)}),
+                   timeout * 1000);
+evaluate();
+'''
+
+# Installed into every page before its own scripts run. Keeps track of all
+# WebRTC connections for WEBRTC_STATS_SCRIPT and makes room for the many
+# resources of the BBB client in the resource timing buffer.
+PERFORMANCE_INIT_SCRIPT = '''
+performance.setResourceTimingBufferSize(1000);
+window.__bbbPeerConnections = [];
+if (window.RTCPeerConnection) {
+    window.RTCPeerConnection = class extends window.RTCPeerConnection {
+        constructor(...args) {
+            super(...args);
+            window.__bbbPeerConnections.push(this);
+        }
+    };
+    window.webkitRTCPeerConnection = window.RTCPeerConnection;
+}
+'''
+
+# Reduces the navigation and resource timing of the current page to a few
+# numbers, all durations in seconds.
+PAGE_TIMING_SCRIPT = '''
+const [nav] = performance.getEntriesByType('navigation');
+const resources = performance.getEntriesByType('resource');
+const scripts = resources.filter(entry => entry.initiatorType === 'script');
+return {
+    navigation: nav ? {
+        redirect: (nav.redirectEnd - nav.redirectStart) / 1000,
+        dns: (nav.domainLookupEnd - nav.domainLookupStart) / 1000,
+        connect: (nav.connectEnd - nav.connectStart) / 1000,
+        tls: nav.secureConnectionStart > 0 ? (nav.connectEnd - nav.secureConnectionStart) / 1000 : null,
+        ttfb: (nav.responseStart - nav.requestStart) / 1000,
+        download: (nav.responseEnd - nav.responseStart) / 1000,
+        dom_content_loaded: nav.domContentLoadedEventEnd > 0 ? nav.domContentLoadedEventEnd / 1000 : null,
+        load: nav.loadEventEnd > 0 ? nav.loadEventEnd / 1000 : null,
+    } : {},
+    resources: resources.length,
+    transfer_bytes: resources.reduce((sum, entry) => sum + entry.transferSize, nav ? nav.transferSize : 0),
+    script_download: Math.max(0, ...scripts.map(entry => entry.responseEnd - entry.startTime)) / 1000,
+};
+'''
+
+# Collects the round trip times of the active candidate pairs and the
+# inbound RTP statistics of all WebRTC connections of the page.
+WEBRTC_STATS_SCRIPT = '''
+const done = arguments[arguments.length - 1];
+const connections = (window.__bbbPeerConnections || []).filter(pc => pc.connectionState !== 'closed');
+Promise.all(connections.map(pc => pc.getStats())).then(reports => {
+    const result = {rtt: [], inbound: []};
+    for (const report of reports) {
+        report.forEach(stat => {
+            if (stat.type === 'candidate-pair' && stat.nominated && stat.currentRoundTripTime !== undefined) {
+                result.rtt.push(stat.currentRoundTripTime);
+            } else if (stat.type === 'inbound-rtp') {
+                result.inbound.push({
+                    kind: stat.kind,
+                    jitter: stat.jitter || 0,
+                    packetsLost: stat.packetsLost || 0,
+                    packetsReceived: stat.packetsReceived || 0,
+                    framesDecoded: stat.framesDecoded || 0,
+                });
+            }
+        });
+    }
+    done(result);
+}, error => done({error: String(error)}));
+'''
 
 
 class BBBError(Exception):
-    pass
+    def __init__(self, message, kind=None):
+        super().__init__(message)
+        self.kind = kind
+
 
+def classify(exc):
+    """Tell the kind of failure behind an exception, None if it depends on the scenario."""
+    chain = []
+    while exc is not None:
+        chain.append(exc)
+        exc = exc.__cause__
+    for exc in chain:
+        if isinstance(exc, (bbb.Error, RequestsConnectionError)):
+            return 'unreachable'
+        if isinstance(exc, WebDriverException) and 'net::ERR_' in (exc.msg or ''):
+            return 'unreachable'
+    return next((exc.kind for exc in chain if isinstance(exc, BBBError) and exc.kind), None)
 
-def wrap_bbb_error(text):
+
+def wrap_bbb_error(text, kind=None):
+    """Run a step of BBBDriver in a span and within the time budget of the step, raising BBBError on failure."""
     def outer(func):
-        def inner(*args, **kwargs):
+        @functools.wraps(func)
+        def inner(self, *args, **kwargs):
+            outer_deadline = self._deadline
+            budget = self.budgets.budget(func.__name__) if self.budgets else None
+            start = time.monotonic()
+            if budget is not None:
+                self._deadline = min(outer_deadline or math.inf, start + budget)
             try:
-                return func(*args, **kwargs)
+                with spans.span(func.__name__):
+                    result = func(self, *args, **kwargs)
             except Exception as exc:
-                raise BBBError(text) from exc
+                if budget is not None and time.monotonic() >= start + budget:
+                    self.budgets.exceeded(func.__name__)
+                raise BBBError(text, kind) from exc
+            finally:
+                self._deadline = outer_deadline
+            if self.budgets:
+                self.budgets.record(func.__name__, time.monotonic() - start)
+            return result
         return inner
     return outer
 
 
+class CanvasUnsupported(Exception):
+    pass
+
+
+class ObserverUnsupported(Exception):
+    pass
+
+
+def pixel_in_range(pixel, lower, upper):
+    return all(low <= value <= up for value, low, up in zip(pixel[:3], lower, upper))
+
+
 class BBBDriver():
-    def __init__(self, join_url, headless=True):
+    def __init__(self, headless=True, pixel_mode='canvas', wait_mode='observer', launch_profile='default',
+                 browser_template=None, browser_cache_dir=None):
+        # directories of this browser only, removed when it quits
+        self._dirs = []
         chrome_options = webdriver.chrome.options.Options()
         chrome_options.add_argument("--use-fake-ui-for-media-stream")
-        chrome_options.add_argument("--use-fake-device-for-media-stream")
+        if launch_profile == 'dense':
+            chrome_options.add_argument(f"--use-fake-device-for-media-stream={DENSE_CAMERA}")
+            for argument in DENSE_CHROME_ARGUMENTS:
+                chrome_options.add_argument(argument)
+        else:
+            chrome_options.add_argument("--use-fake-device-for-media-stream")
         chrome_options.add_argument("--use-fake-device-for-audio-stream")
         if headless:
             chrome_options.add_argument("--headless")
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.set_script_timeout(20)
-        self.driver.set_page_load_timeout(20)
-        self._join_url = join_url
-
-    def join(self):
-        self.driver.get(self._join_url)
-        self.driver.execute_script(f'window.open("{self._join_url}");')
+        try:
+            if browser_template:
+                # a profile can only be used by one browser at a time, so every browser gets a copy
+                data_dir = os.path.join(self._private_dir(None), 'profile')
+                shutil.copytree(browser_template, data_dir)
+                chrome_options.add_argument(f"--user-data-dir={data_dir}")
+            if browser_cache_dir:
+                chrome_options.add_argument(f"--disk-cache-dir={self._private_dir(browser_cache_dir)}")
+            with spans.span('start_browser'):
+                self.driver = webdriver.Chrome(options=chrome_options)
+        except BaseException:
+            self._remove_dirs()
+            raise
+        self.driver.set_script_timeout(SELENIUM_TIMEOUT)
+        self.script_timeout = SELENIUM_TIMEOUT
+        self.driver.set_page_load_timeout(SELENIUM_TIMEOUT)
+        self._install_performance_hooks()
+        self.driver.get('about:blank')
+        self.uses = 0
+        self.pixel_mode = pixel_mode
+        self.wait_mode = wait_mode
+        self.camera_quality = CAMERA_QUALITY[launch_profile]
+        # the StepBudgets and Selectors of the host currently probed
+        self.budgets = None
+        self.selectors = Selectors()
+        self._deadline = None
+
+    def _private_dir(self, parent):
+        path = tempfile.mkdtemp(prefix='bbb-selenium-', dir=parent)
+        self._dirs.append(path)
+        return path
+
+    def _remove_dirs(self):
+        for path in self._dirs:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _install_performance_hooks(self):
+        # applies to all documents loaded in the current window from now on
+        self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': PERFORMANCE_INIT_SCRIPT})
+
+    @spans.traced
+    def join(self, join_url):
+        self.uses += 1
+        self.driver.get(join_url)
+        # open the second window empty, so the hooks are in place before it loads the client
+        self.driver.execute_script('window.open("about:blank");')
+        self.driver.switch_to.window(self.driver.window_handles[1])
+        self._install_performance_hooks()
+        self.driver.execute_script(f'window.location.href = "{join_url}";')
         self.driver.switch_to.window(self.driver.window_handles[0])
 
+    def page_timing(self):
+        """Navigation and resource timing of the current page, as measured by the browser."""
+        return self.driver.execute_script(PAGE_TIMING_SCRIPT)
+
+    def webrtc_stats(self):
+        """Round trip times and inbound RTP statistics of the WebRTC connections of the current page."""
+        result = self.driver.execute_async_script(WEBRTC_STATS_SCRIPT)
+        if 'error' in result:
+            raise BBBError(f'failed to get WebRTC stats: {result["error"]}')
+        return result
+
+    @spans.traced
+    def reset(self):
+        for handle in self.driver.window_handles[1:]:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.driver.switch_to.window(self.driver.window_handles[0])
+        self.driver.switch_to.default_content()
+        origin = self.driver.execute_script('return window.location.origin;')
+        if origin and origin != 'null':
+            self.driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+        self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        self.driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        self.driver.get('about:blank')
+
+    def rss(self):
+        """Resident memory of chromedriver and all browser processes in bytes."""
+        return proc.tree_rss(self.driver.service.process.pid)
+
+    CONDITIONS = {
+        'present': expected_conditions.presence_of_element_located,
+        'visible': expected_conditions.visibility_of_element_located,
+        'clickable': expected_conditions.element_to_be_clickable,
+        'invisible': expected_conditions.invisibility_of_element_located,
+    }
+
+    def _wait_all(self, timeout, *conditions):
+        """Wait until all (state, selector) conditions hold and return the element of each.
+
+        A selector is either the name of an element in SELECTORS, found by any
+        of its variants, or a (by, value) tuple. In observer mode all
+        conditions are checked in the page on every change of the document,
+        taking a single round trip. In poll mode, or if that fails, they are
+        polled one after another using WebDriverWait.
+        """
+        timeout = self._timeout(timeout)
+        conditions = [(state, selector, self._variants(selector)) for state, selector in conditions]
+        result = None
+        if self.wait_mode == 'observer':
+            try:
+                result = self._wait_observer(timeout, conditions)
+            except ObserverUnsupported as exc:
+                log.debug(f'falling back to polling: {exc}')
+        if result is None:
+            deadline = time.monotonic() + timeout
+            found = [WebDriverWait(self.driver, max(0, deadline - time.monotonic())).until(self._poll_condition(state, variants))
+                     for state, _, variants in conditions]
+            result = {'elements': [element for element, _ in found], 'variants': [index for _, index in found], 'version': None}
+        for (_, selector, variants), index in zip(conditions, result['variants']):
+            if isinstance(selector, str) and index is not None:
+                self.selectors.record(selector, variants[index], result['version'])
+        return result['elements']
+
+    def _variants(self, selector):
+        if isinstance(selector, str):
+            return self.selectors.variants(selector)
+        return (Variant('fixed', *selector),)
+
+    def _poll_condition(self, state, variants):
+        conditions = [self.CONDITIONS[state]((variant.by, variant.value)) for variant in variants]
+
+        def holds(condition, driver):
+            # a variant not found must not keep the others from being checked
+            try:
+                return condition(driver)
+            except (NoSuchElementException, StaleElementReferenceException):
+                return False
+
+        def check(driver):
+            if state == 'invisible':
+                return all(holds(condition, driver) for condition in conditions) and (None, None)
+            for index, condition in enumerate(conditions):
+                element = holds(condition, driver)
+                if element:
+                    return element, index
+            return False
+        return check
+
+    def _timeout(self, timeout):
+        """Shorten the timeout of a wait to what is left of the budget of the current step."""
+        if self._deadline is None:
+            return timeout
+        return max(0, min(timeout, self._deadline - time.monotonic()))
+
+    def _wait_observer(self, timeout, conditions):
+        args = [[[[variant.by, variant.value] for variant in variants], state] for state, _, variants in conditions]
+        self._set_script_timeout(timeout + SHORT_TIMEOUT)
+        try:
+            result = self.driver.execute_async_script(WAIT_SCRIPT, args, timeout)
+        except JavascriptException as exc:
+            raise ObserverUnsupported(exc.msg) from exc
+        if 'error' in result:
+            raise ObserverUnsupported(result['error'])
+        if 'pending' in result:
+            pending = [conditions[index][:2] for index in result['pending']]
+            raise TimeoutException(f'waited {timeout}s for {pending}')
+        return result
+
+    def _set_script_timeout(self, timeout):
+        # Async scripts bring their own deadline, so the timeout is only
+        # changed when needed to save a round trip per script.
+        if timeout > self.script_timeout:
+            self.driver.set_script_timeout(timeout)
+            self.script_timeout = timeout
+
     def _wait_clickable(self, timeout, selector):
-        return WebDriverWait(self.driver, timeout).until(
-                expected_conditions.element_to_be_clickable(selector))
+        return self._wait_all(timeout, ('clickable', selector))[0]
 
     def _wait_present(self, timeout, selector):
-        return WebDriverWait(self.driver, timeout).until(
-                expected_conditions.presence_of_element_located(selector))
+        return self._wait_all(timeout, ('present', selector))[0]
 
     def _wait_visible(self, timeout, selector):
-        return WebDriverWait(self.driver, timeout).until(
-                expected_conditions.visibility_of_element_located(selector))
+        return self._wait_all(timeout, ('visible', selector))[0]
 
     def _wait_invisible(self, timeout, selector):
-        return WebDriverWait(self.driver, timeout).until(
-                expected_conditions.invisibility_of_element_located(selector))
+        return self._wait_all(timeout, ('invisible', selector))[0]
 
-    @wrap_bbb_error('mic error')
+    @wrap_bbb_error('mic error', 'media')
     def enter_with_mic(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".audioBtn--1H6rCK")).click()
+        self._wait_clickable(SELENIUM_TIMEOUT, 'microphone').click()
 
-    @wrap_bbb_error('no echo test error')
+    @wrap_bbb_error('no echo test error', 'media')
     def wait_for_echo_test(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".button--1JElwW")).click()
+        self._wait_clickable(SELENIUM_TIMEOUT, 'echo_yes').click()
 
-    @wrap_bbb_error('no audio error')
+    @wrap_bbb_error('no audio error', 'media')
     def enter_without_audio(self):
-        self._wait_present(SELENIUM_TIMEOUT, (By.XPATH, "//button[@aria-label='Close Join audio modal']")).click()
+        self._wait_present(SELENIUM_TIMEOUT, 'close_audio').click()
 
+    @wrap_bbb_error('headphone error', 'media')
     def enter_with_headphones(self):
-        try:
-            self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".icon-bbb-listen")).click()
-        except Exception as exc:
-            raise BBBError('headphone error') from exc
+        self._wait_clickable(SELENIUM_TIMEOUT, 'listen_only').click()
 
-    @wrap_bbb_error('overlay error')
+    @wrap_bbb_error('overlay error', 'media')
     def wait_for_overlays_to_disappear(self):
-        self._wait_invisible(SHORT_TIMEOUT, (By.CSS_SELECTOR, ".icon-bbb-unmute"))
-        self._wait_invisible(SHORT_TIMEOUT, (By.CSS_SELECTOR, ".ReactModal__Overlay"))
+        self._wait_all(SHORT_TIMEOUT,
+                       ('invisible', (By.CSS_SELECTOR, ".icon-bbb-unmute")),
+                       ('invisible', (By.CSS_SELECTOR, ".ReactModal__Overlay")))
 
     @wrap_bbb_error('presentation upload error')
     def upload_presentation(self): 
         pdf_path = pkg_resources.resource_filename(__name__, 'assets/red.pdf')
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".button--ZzeTUF")).click()
-        self._wait_visible(SELENIUM_TIMEOUT, (By.XPATH, "//span[text()='Upload a presentation']")).click()
+        self._wait_clickable(SELENIUM_TIMEOUT, 'actions').click()
+        self._wait_visible(SELENIUM_TIMEOUT, 'upload_menu').click()
         self._wait_visible(SELENIUM_TIMEOUT, (By.XPATH, "//input[@type='file']")).send_keys(pdf_path)
-        self._wait_visible(SELENIUM_TIMEOUT, (By.XPATH, "//button[@aria-label='Upload ']")).click()
-        self._wait_invisible(SELENIUM_TIMEOUT, (By.XPATH, "//button[@aria-label='Upload ']"))
+        self._wait_visible(SELENIUM_TIMEOUT, 'upload_confirm').click()
+        self._wait_invisible(SELENIUM_TIMEOUT, 'upload_confirm')
         self._check_for_presentation()
 
-    @wrap_bbb_error('video start error')
+    @wrap_bbb_error('video start error', 'media')
     def switch_on_video(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.XPATH, "//button[@aria-label='Share webcam']")).click()
-        Select(self._wait_present(SELENIUM_TIMEOUT, (By.ID, "setQuality"))).select_by_value('medium')
-        self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".primary--1IbqAO > .label--Z12LMR3:nth-child(1)")).click()
-        self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".cursorGrab--Z2fB4yK"))
+        self._wait_clickable(SELENIUM_TIMEOUT, 'share_webcam').click()
+        Select(self._wait_present(SELENIUM_TIMEOUT, (By.ID, "setQuality"))).select_by_value(self.camera_quality)
+        self._wait_present(SELENIUM_TIMEOUT, 'start_sharing').click()
+        self._wait_present(SELENIUM_TIMEOUT, 'webcam')
 
     @wrap_bbb_error('chat send error')
-    def send_chat_message(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".input--2wilPX")).click()
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".input--2wilPX")).send_keys("hallo Chat\n")
-        chat = self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".content--Z2nhld9"))
-        assert "hallo Chat" in chat.text
+    def send_chat_message(self, text="hallo Chat"):
+        self._wait_clickable(SELENIUM_TIMEOUT, 'chat_input').click()
+        self._wait_clickable(SELENIUM_TIMEOUT, 'chat_input').send_keys(f"{text}\n")
+        chat = self._wait_present(SELENIUM_TIMEOUT, 'chat_messages')
+        assert text in chat.text
 
     @wrap_bbb_error('poll start error')
     def start_poll(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".button--ZzeTUF")).click()
-        self._wait_visible(SELENIUM_TIMEOUT, (By.XPATH, "//span[text()='Start a poll']")).click()
-        self._wait_present(SELENIUM_TIMEOUT, (By.XPATH, "//button[@aria-label='Yes / No']")).click()
+        self._wait_clickable(SELENIUM_TIMEOUT, 'actions').click()
+        self._wait_visible(SELENIUM_TIMEOUT, 'poll_menu').click()
+        self._wait_present(SELENIUM_TIMEOUT, 'poll_yes_no').click()
 
     @wrap_bbb_error('pad enter error')
     def enter_pad(self):
-        self._wait_clickable(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".listItem--Siv4F")).click()
-        self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".note--1ESx6q"))
-        self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".userlistPad--o5KDX"))
+        self._wait_clickable(SELENIUM_TIMEOUT, 'notes').click()
+        self._wait_all(SELENIUM_TIMEOUT,
+                       ('present', 'notes_panel'),
+                       ('present', 'notes_pad'))
 
         for _ in range(3):
-            self._wait_present(SELENIUM_TIMEOUT, (By.TAG_NAME, "iframe"))
-            iframe = self.driver.find_element(by=By.TAG_NAME, value='iframe')
+            iframe = self._wait_present(SELENIUM_TIMEOUT, (By.TAG_NAME, "iframe"))
             self.driver.switch_to.frame(iframe)
 
     @wrap_bbb_error('pad edit error')
@@ -146,40 +775,67 @@ class BBBDriver():
 
     @wrap_bbb_error('poll error')
     def check_for_poll(self):
-        self._wait_present(SHORT_TIMEOUT, (By.XPATH, "//button[@aria-label='Yes']")).click()
+        self._wait_present(SHORT_TIMEOUT, 'poll_answer_yes').click()
 
     def _check_for_presentation(self):
-        return self._wait_screenshot_pixel(
-                (By.CSS_SELECTOR, ".svgContainer--Z1z3wO0"),
-                lambda pixels, pres: pixels[pres.size['width'] / 2, pres.size['height'] / 2],
-                lambda pixel: pixel[0] > 200 and pixel[1] < 50 and pixel[2] < 50)
+        return self._wait_pixel(
+                'presentation', None,
+                (201, 0, 0), (255, 49, 49))
 
+    @wrap_bbb_error('no video error', 'media')
     def check_for_video(self):
-        return self._wait_screenshot_pixel(
-                (By.CSS_SELECTOR, ".cursorGrab--Z2fB4yK"),
-                lambda pixels, _: pixels[2, 20],
-                lambda pixel: pixel[0] < 50 and pixel[1] > 70 and pixel[2] < 50)
-
-    def _wait_screenshot_pixel(self, selector, get_pixel, pixel_ok, max_tries=MAX_TRIES):
-        for _ in range(max_tries):
-            time.sleep(1)
+        return self._wait_pixel(
+                'webcam', (2, 20),
+                (0, 71, 0), (49, 255, 49))
+
+    def _wait_pixel(self, selector, point, lower, upper, timeout=PIXEL_TIMEOUT):
+        """Wait until the pixel at point (the center if None) of the element is within the color bounds."""
+        timeout = self._timeout(timeout)
+        if self.pixel_mode == 'canvas':
+            try:
+                return self._wait_canvas_pixel(selector, point, lower, upper, timeout)
+            except CanvasUnsupported as exc:
+                log.debug(f'falling back to screenshots: {exc}')
+        return self._wait_screenshot_pixel(selector, point, lower, upper, timeout)
+
+    def _wait_canvas_pixel(self, selector, point, lower, upper, timeout):
+        # the variants are sampled together as one selector list
+        value = ', '.join(variant.value for variant in self._variants(selector) if variant.by == By.CSS_SELECTOR)
+        if not value:
+            raise CanvasUnsupported(f'cannot sample {selector} in page')
+        self._set_script_timeout(timeout + SHORT_TIMEOUT)
+        with spans.span('canvas_pixel'):
+            result = self.driver.execute_async_script(PIXEL_SCRIPT, value, point, lower, upper, timeout)
+        if 'error' in result:
+            raise CanvasUnsupported(result['error'])
+        if result['pixel'] is None or not pixel_in_range(result['pixel'], lower, upper):
+            raise TimeoutError(f'pixel {result["pixel"]} never matched')
+
+    def _wait_screenshot_pixel(self, selector, point, lower, upper, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
             try:
                 element = self._wait_present(1, selector)
             except:
                 continue
-            with NamedTemporaryFile(suffix='.png') as tmp:
-                element.screenshot(tmp.name)
-                pixels = Image.open(tmp.name).load()
-            pixel = get_pixel(pixels, element)
-            if pixel_ok(pixel):
+            png = element.screenshot_as_png
+            with spans.span('screenshot_decode'):
+                pixels = Image.open(BytesIO(png)).convert('RGB').load()
+            x, y = point or (element.size['width'] / 2, element.size['height'] / 2)
+            if pixel_in_range(pixels[int(x), int(y)], lower, upper):
                 return
+            time.sleep(PIXEL_POLL_INTERVAL)
 
         raise TimeoutError("max tries exceeded")
 
     @wrap_bbb_error('chat message not found')
-    def check_for_chat_message(self):
-        chat = self._wait_present(SELENIUM_TIMEOUT, (By.CSS_SELECTOR, ".content--Z2nhld9"))
-        assert "hallo Chat" in chat.text
+    def check_for_chat_message(self, text="hallo Chat"):
+        chat = self._wait_present(SELENIUM_TIMEOUT, 'chat_messages')
+        assert text in chat.text
+
+    def frames_decoded(self):
+        """Video frames decoded so far by all WebRTC connections of the current page."""
+        return sum(stream['framesDecoded'] for stream in self.webrtc_stats()['inbound'] if stream['kind'] == 'video')
 
     @wrap_bbb_error('etherpad line not found')
     def check_for_etherpad(self):
@@ -199,100 +855,758 @@ class BBBDriver():
         return self
 
     def __exit__(self, *args):
-        self.driver.quit()
+        self.quit()
+
+    @spans.traced
+    def quit(self):
+        try:
+            self.driver.quit()
+        finally:
+            self._remove_dirs()
+
+
+class DriverPool():
+    """Keeps pre-launched browser sessions around for reuse by consecutive probes.
+
+    A pool belongs to exactly one worker process. Sessions may be acquired
+    concurrently by the scenario lanes of a probe. Sessions that were quit
+    are only replaced by fill(), which the worker calls between probes.
+    """
+
+    def __init__(self, size=1, max_uses=20, max_rss=None, **driver_options):
+        self.size = size
+        self.driver_options = driver_options
+        self.max_uses = max_uses
+        self.max_rss = max_rss
+        self._idle = []
+        self._lock = Lock()
+
+    def fill(self):
+        while len(self._idle) < self.size:
+            try:
+                conn = BBBDriver(**self.driver_options)
+            except Exception as exc:
+                log.warning(f'failed to pre-launch browser: {exc}')
+                return
+            with self._lock:
+                self._idle.append(conn)
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                POOL_HITS.inc()
+                return self._idle.pop()
+        POOL_COLD_STARTS.inc()
+        return BBBDriver(**self.driver_options)
+
+    def release(self, conn, failed=False):
+        reason = self._recycle_reason(conn, failed)
+        if reason is None:
+            try:
+                conn.reset()
+            except Exception as exc:
+                log.debug(exc, exc_info=True)
+                reason = 'reset_failed'
+
+        with self._lock:
+            if reason is None and len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            POOL_RECYCLES.labels(reason or 'pool_full').inc()
+            self._quit(conn)
+
+    def _recycle_reason(self, conn, failed):
+        if failed:
+            return 'error'
+        if self.max_uses and conn.uses >= self.max_uses:
+            return 'max_uses'
+        if self.max_rss:
+            try:
+                if conn.rss() > self.max_rss:
+                    return 'memory'
+            except Exception as exc:
+                log.debug(exc, exc_info=True)
+        return None
+
+    @staticmethod
+    def _quit(conn):
+        try:
+            conn.quit()
+        except Exception as exc:
+            log.debug(exc, exc_info=True)
+
+    @contextmanager
+    def session(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, failed=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        while self._idle:
+            self._quit(self._idle.pop())
+
+
+class LiveMeeting():
+    """A meeting kept alive after a full probe together with the browser sessions joined to it."""
+
+    def __init__(self, room, sessions, chat_conn, video_conn, duration):
+        self.room = room
+        self.sessions = sessions
+        self.chat_conn = chat_conn
+        self.video_conn = video_conn
+        self.duration = duration
+        self.created = time.monotonic()
+        self.checks = 0
+        self.frames = 0
+        # the success and duration of the scenarios of the probe that built the meeting
+        self.scenarios = dict()
+
+    def age(self):
+        return time.monotonic() - self.created
+
+    def close(self):
+        try:
+            self.sessions.close()
+        except Exception as exc:
+            log.debug(exc, exc_info=True)
+
+
+class LiveMeetings():
+    """The meetings one worker process keeps alive between probes, by host.
+
+    At most size meetings are kept, ending the least recently probed one
+    first, and none of them longer than max_age seconds.
+    """
+
+    def __init__(self, size=1, max_age=3600):
+        self.size = size
+        self.max_age = max_age
+        self._meetings = OrderedDict()
+
+    def take(self, hostname):
+        meeting = self._meetings.pop(hostname, None)
+        if meeting is not None and meeting.age() > self.max_age:
+            self._end(meeting, 'expired')
+            return None
+        return meeting
+
+    def keep(self, hostname, meeting):
+        self._meetings[hostname] = meeting
+        while len(self._meetings) > self.size:
+            _, oldest = self._meetings.popitem(last=False)
+            self._end(oldest, 'evicted')
+
+    def end(self, meeting, reason):
+        self._end(meeting, reason)
+
+    def hosts(self):
+        return tuple(self._meetings)
+
+    def close(self):
+        while self._meetings:
+            self._end(self._meetings.popitem()[1], 'shutdown')
+
+    @staticmethod
+    def _end(meeting, reason):
+        LIVE_ENDED.labels(reason).inc()
+        meeting.close()
+
+
+class StepBudgets():
+    """Time budgets for the steps of probes of one host, learned from its recent successful runs.
+
+    A step may take factor times as long as the slowest of its last
+    successful runs, but at least BUDGET_FLOOR seconds. Steps that did not
+    succeed often enough yet keep the full timeouts of their waits. A step
+    that ran out of its budget forgets its runs, so a host that got slower
+    is measured with the full timeouts again instead of failing for good.
+    """
+
+    def __init__(self, factor):
+        self.factor = factor
+        self._durations = dict()
+
+    def record(self, step, duration):
+        self._durations.setdefault(step, deque(maxlen=BUDGET_SAMPLES)).append(duration)
+
+    def exceeded(self, step):
+        self._durations.pop(step, None)
+
+    def budget(self, step):
+        durations = self._durations.get(step)
+        if not durations or len(durations) < BUDGET_MIN_SAMPLES:
+            return None
+        return max(BUDGET_FLOOR, max(durations) * self.factor)
+
+    def budgets(self):
+        return {step: self.budget(step) for step in list(self._durations) if self.budget(step) is not None}
+
+
+class Selectors():
+    """The variants of SELECTORS that found the elements of the BBB client of one host.
+
+    The variant that matched last is looked for first. Everything learned is
+    forgotten once the client reports another version, e.g. after an upgrade.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.matched = dict()
+        # the lanes of a probe wait concurrently
+        self._lock = Lock()
+
+    def variants(self, name):
+        matched = self.matched.get(name)
+        # sorting is stable, so the remaining variants keep their order
+        return tuple(sorted(SELECTORS[name], key=lambda variant: variant.name != matched))
+
+    def record(self, name, variant, version=None):
+        with self._lock:
+            if version and version != self.version:
+                if self.version is not None:
+                    log.info(f'BBB client changed from {self.version} to {version}, resolving selectors again')
+                    self.matched.clear()
+                self.version = version
+            self.matched[name] = variant.name
+
+    def __getstate__(self):
+        # handed between the exporter and its workers, without the lock
+        return {'version': self.version, 'matched': self.matched}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
 
 
 Gauges = namedtuple('Gauges', ['success', 'duration'])
 
 
+class Failure():
+    """The result of a failed scenario, as falsy as False but telling the kind of failure."""
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __bool__(self):
+        return False
+
+
 def bbb_scenario(gauges):
     def wrapper(func):
+        @functools.wraps(func)
         def inner(*args, **kwargs):
             with gauges.duration.time():
                 try:
-                    func(*args, **kwargs)
+                    with spans.span(func.__name__):
+                        func(*args, **kwargs)
                     gauges.success.set(True)
                     return True
                 except Exception as exc:
                     log.debug(exc, exc_info=True)
-                    return False
+                    return Failure(classify(exc))
         return inner
     return wrapper
 
 
-def collect(hostname, secret, headless=True):
+def record_page_timing(registry, hostname, conn):
+    """Add the navigation and resource timing of the current page of conn to the registry."""
+    try:
+        timing = conn.page_timing()
+    except Exception as exc:
+        log.debug(exc, exc_info=True)
+        return
+
+    navigation = Gauge('browser_navigation_seconds', 'Duration of the phases of loading the BBB client', ['backend', 'phase'], registry=registry)
+    for phase, seconds in timing['navigation'].items():
+        if seconds is not None:
+            navigation.labels(hostname, phase).set(seconds)
+    Gauge('browser_resources', 'Resources loaded by the BBB client', ['backend'], registry=registry).labels(hostname).set(timing['resources'])
+    Gauge('browser_transfer_bytes', 'Bytes transferred to load the BBB client and its resources', ['backend'],
+          registry=registry).labels(hostname).set(timing['transfer_bytes'])
+    Gauge('browser_script_download_seconds', 'Duration of loading the slowest script of the BBB client', ['backend'],
+          registry=registry).labels(hostname).set(timing['script_download'])
+
+
+def record_webrtc_stats(registry, hostname, conn):
+    """Add the statistics of the WebRTC connections of the current page of conn to the registry."""
+    try:
+        stats = conn.webrtc_stats()
+    except Exception as exc:
+        log.debug(exc, exc_info=True)
+        return
+
+    if stats['rtt']:
+        Gauge('webrtc_round_trip_time_seconds', 'Highest round trip time of the WebRTC connections', ['backend'],
+              registry=registry).labels(hostname).set(max(stats['rtt']))
+    jitter = Gauge('webrtc_jitter_seconds', 'Highest jitter of the received streams', ['backend', 'kind'], registry=registry)
+    lost = Gauge('webrtc_packets_lost', 'Packets of the received streams lost', ['backend', 'kind'], registry=registry)
+    received = Gauge('webrtc_packets_received', 'Packets of the received streams received', ['backend', 'kind'], registry=registry)
+    decoded = Gauge('webrtc_frames_decoded', 'Frames of the received video streams decoded', ['backend'], registry=registry)
+    for kind in sorted({stream['kind'] for stream in stats['inbound']}):
+        streams = [stream for stream in stats['inbound'] if stream['kind'] == kind]
+        jitter.labels(hostname, kind).set(max(stream['jitter'] for stream in streams))
+        lost.labels(hostname, kind).set(sum(stream['packetsLost'] for stream in streams))
+        received.labels(hostname, kind).set(sum(stream['packetsReceived'] for stream in streams))
+        if kind == 'video':
+            decoded.labels(hostname).set(sum(stream['framesDecoded'] for stream in streams))
+
+
+def record_profile(registry, hostname, profile):
+    Gauge('probe_profile_info', 'Profile of scenarios run by the probe', ['backend', 'profile'],
+          registry=registry).labels(hostname, profile.name if profile else 'full').set(1)
+
+
+def unfinished_probe(hostname, profile, reason):
+    """The registry of a probe that never finished, e.g. because its worker was killed, with all its scenarios failed."""
+    registry = CollectorRegistry(auto_describe=True)
+    record_profile(registry, hostname, profile)
+    selected = profile.scenarios if profile else SCENARIOS
+    # every scenario requires connecting to the server
+    for slug in (slug for slug in SCENARIOS if slug in selected or slug == 'connect_server'):
+        description = SCENARIO_DESCRIPTIONS[slug]
+        Gauge(f'{slug}_success', f'Success of {description}', ['backend'], registry=registry).labels(hostname).set(False)
+        Gauge(f'{slug}_duration_seconds', f'Duration of {description}', ['backend'], registry=registry).labels(hostname).set(0)
+    Gauge('probe_unfinished', 'Probe that never finished because its worker was killed or died', ['backend', 'reason'],
+          registry=registry).labels(hostname, reason).set(1)
+    return registry
+
+
+def probe_succeeded(registry):
+    return all(sample.value for metric in registry.collect() for sample in metric.samples
+               if sample.name.endswith('_success'))
+
+
+def probe_unreachable(registry):
+    """Whether the probe failed before it got into a meeting, see FATAL_FAILURES."""
+    return any(sample.value and sample.labels.get('kind') in FATAL_FAILURES for metric in registry.collect()
+               if metric.name == 'scenario_failure_info' for sample in metric.samples)
+
+
+MAIN_LANE = 'main'
+
+Scenario = namedtuple('Scenario', ['name', 'run', 'lane', 'after', 'requires', 'fallback', 'kind'])
+
+
+class ScenarioGraph():
+    """Runs scenarios in dependency order, each lane in its own thread.
+
+    A lane is one browser session joined to the meeting. Scenarios of the same
+    lane run one after another in the order they were added, scenarios of
+    different lanes run concurrently once everything in ``after`` finished and
+    everything in ``requires`` succeeded. Without ``parallel`` every scenario
+    is put on the main lane, which reproduces the plain sequential probe.
+
+    Every failure is classified, falling back to the ``kind`` of the failed
+    scenario, and scenarios that cannot succeed after it are skipped instead
+    of running into their timeouts.
+    """
+
+    def __init__(self, parallel=False):
+        self.parallel = parallel
+        self.scenarios = OrderedDict()
+        self.results = dict()
+        self.failures = dict()
+        self.skipped = dict()
+
+    def scenario(self, lane=MAIN_LANE, after=(), requires=(), fallback=None, kind='feature'):
+        def wrapper(func):
+            lane_name = lane if self.parallel else MAIN_LANE
+            self.scenarios[func.__name__] = Scenario(func.__name__, func, lane_name, tuple(after), tuple(requires), fallback, kind)
+            return func
+        return wrapper
+
+    def _skip_cause(self, scenario):
+        for name in scenario.requires:
+            if not self.results.get(name):
+                return self.failures.get(name) or self.skipped.get(name) or 'feature'
+        for kind in list(self.failures.values()):
+            if kind in FATAL_FAILURES:
+                return kind
+        return None
+
+    def select(self, names=None):
+        """The scenarios to run for a subset of them, including everything they require."""
+        if names is None:
+            return set(self.scenarios)
+        selected = set()
+        pending = [name for name in names if name in self.scenarios]
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.scenarios[name].requires)
+        return selected
+
+    def run(self, open_lane, selected=None, on_finished=None):
+        """Run the selected scenarios, calling on_finished with the name of every scenario run or skipped."""
+        selected = self.select() if selected is None else selected
+        lanes = OrderedDict()
+        for scenario in self.scenarios.values():
+            if scenario.name in selected:
+                lanes.setdefault(scenario.lane, []).append(scenario)
+
+        finished = {name: Event() for name in self.scenarios}
+        for name in set(self.scenarios) - selected:
+            # what a scenario runs after may be left out
+            finished[name].set()
+        results = self.results
+
+        def run_lane(lane, scenarios):
+            conn = None
+            current = None
+            try:
+                for scenario in scenarios:
+                    current = scenario
+                    for name in scenario.after + scenario.requires:
+                        finished[name].wait()
+                    cause = self._skip_cause(scenario)
+                    if cause:
+                        results[scenario.name] = False
+                        self.skipped[scenario.name] = cause
+                        finished[scenario.name].set()
+                        if on_finished:
+                            on_finished(scenario.name)
+                        continue
+                    if conn is None:
+                        conn = open_lane(lane)
+                    outcome = scenario.run(conn)
+                    results[scenario.name] = bool(outcome)
+                    if not outcome:
+                        self.failures[scenario.name] = getattr(outcome, 'kind', None) or scenario.kind
+                    if not outcome and scenario.fallback:
+                        scenario.fallback(conn)
+                    finished[scenario.name].set()
+                    if on_finished:
+                        on_finished(scenario.name)
+            except Exception as exc:
+                log.exception(exc)
+                # e.g. the browser of the lane failed to start, which must not skip the other lanes
+                kind = classify(exc)
+                kind = 'feature' if kind is None or kind in FATAL_FAILURES else kind
+                for scenario in scenarios:
+                    if scenario.name in results:
+                        continue
+                    results[scenario.name] = False
+                    if scenario is current:
+                        self.failures[scenario.name] = kind
+                    else:
+                        # never ran, as the lane is gone
+                        self.skipped[scenario.name] = kind
+                    finished[scenario.name].set()
+                    if on_finished:
+                        on_finished(scenario.name)
+            finally:
+                for scenario in scenarios:
+                    finished[scenario.name].set()
+
+        threads = [Thread(target=run_lane, args=lane, name=f'lane-{lane[0]}', daemon=True) for lane in lanes.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def check_live(hostname, live):
+    """Re-verify the meeting kept alive for a host, returning None if it has to be rebuilt.
+
+    Instead of running the scenarios again, a chat message has to make the
+    round trip between the windows and the video has to keep decoding frames.
+    """
+    meeting = live.take(hostname)
+    if meeting is None:
+        return None
+
     registry = CollectorRegistry(auto_describe=True)
-    
     labelnames = ['backend']
-    labelvalues = (hostname)
+    record_profile(registry, hostname, LIVE_PROFILE)
 
     def make_gauges(slug, description):
-        success = Gauge(f'{slug}_success', f'Success of {description}', labelnames, registry=registry).labels(labelvalues)
+        success = Gauge(f'{slug}_success', f'Success of {description}', labelnames, registry=registry).labels(hostname)
         success.set(False)
-        duration = Gauge(f'{slug}_duration_seconds', f'Duration of {description}', labelnames, registry=registry).labels(labelvalues)
+        duration = Gauge(f'{slug}_duration_seconds', f'Duration of {description}', labelnames, registry=registry).labels(hostname)
         duration.set(0)
         return Gauges(success, duration)
 
-    @bbb_scenario(make_gauges('connect_server', 'connecting to BBB server'))
+    @bbb_scenario(make_gauges('live_chat', 'chat round trip in live meeting'))
+    def live_chat(conn):
+        text = f'hallo Chat {meeting.checks}'
+        conn.send_chat_message(text)
+        with conn.window(1):
+            conn.check_for_chat_message(text)
+
+    @bbb_scenario(make_gauges('live_video', 'video frames arriving in live meeting'))
+    def live_video(conn):
+        with conn.window(1):
+            frames = conn.frames_decoded()
+        if frames <= meeting.frames:
+            raise BBBError('no video frames decoded since the last check')
+        meeting.frames = frames
+
+    probe_duration = Gauge('probe_duration_seconds', 'Duration of all scenarios along the critical path',
+                           labelnames, registry=registry).labels(hostname)
+    start = time.monotonic()
+    meeting.checks += 1
+    ok = live_chat(meeting.chat_conn) and live_video(meeting.video_conn)
+    duration = time.monotonic() - start
+    if not ok:
+        log.warning(f'live meeting on {hostname} failed, rebuilding it')
+        live.end(meeting, 'failed')
+        return None
+
+    probe_duration.set(duration)
+    # the scenarios stay as they were when the meeting was built, instead of going missing
+    record_scenarios(registry, hostname, meeting.scenarios)
+    Gauge('live_meeting_age_seconds', 'Time since the live meeting was created', labelnames,
+          registry=registry).labels(hostname).set(meeting.age())
+    LIVE_REUSES.inc()
+    LIVE_SECONDS_SAVED.inc(max(0, meeting.duration - duration))
+    live.keep(hostname, meeting)
+    return registry
+
+
+def fake_collect(hostname, secret, profile=None, live=None, progress=None, **kwargs):
+    """Pretend to probe a server without starting a browser, for testing the exporter itself."""
+    if live is not None:
+        meeting = live.take(hostname)
+        if meeting is not None:
+            registry = CollectorRegistry(auto_describe=True)
+            record_profile(registry, hostname, LIVE_PROFILE)
+            success = Gauge('live_chat_success', 'Success of chat round trip in live meeting', ['backend'], registry=registry)
+            duration = Gauge('live_chat_duration_seconds', 'Duration of chat round trip in live meeting', ['backend'], registry=registry)
+            with duration.labels(hostname).time():
+                time.sleep(random.uniform(0.1, 0.3))
+            success.labels(hostname).set(True)
+            record_scenarios(registry, hostname, meeting.scenarios)
+            LIVE_REUSES.inc()
+            LIVE_SECONDS_SAVED.inc(meeting.duration)
+            live.keep(hostname, meeting)
+            return registry
+
+    registry = CollectorRegistry(auto_describe=True)
+    record_profile(registry, hostname, profile)
+    success = Gauge('connect_server_success', 'Success of connecting to BBB server', ['backend'], registry=registry)
+    connect_duration = Gauge('connect_server_duration_seconds', 'Duration of connecting to BBB server', ['backend'], registry=registry)
+    duration = Gauge('probe_duration_seconds', 'Duration of all scenarios along the critical path', ['backend'], registry=registry)
+    start = time.monotonic()
+    with duration.labels(hostname).time(), connect_duration.labels(hostname).time(), spans.span('fake_probe'):
+        time.sleep(random.uniform(0.5, 2))
+    success.labels(hostname).set(True)
+    stream_scenario(registry, 'connect_server', progress)
+    if live is not None:
+        meeting = LiveMeeting(None, ExitStack(), None, None, time.monotonic() - start)
+        meeting.scenarios = scenario_samples(registry, hostname)
+        live.keep(hostname, meeting)
+    return registry
+
+
+def scenario_samples(registry, hostname):
+    """The success and duration of every scenario in the registry."""
+    labels = {'backend': hostname}
+    samples = dict()
+    for slug in SCENARIO_DESCRIPTIONS:
+        success = registry.get_sample_value(f'{slug}_success', labels)
+        if success is not None:
+            samples[slug] = (success, registry.get_sample_value(f'{slug}_duration_seconds', labels) or 0)
+    return samples
+
+
+def record_scenarios(registry, hostname, samples):
+    """Add scenarios as returned by scenario_samples to the registry, marked as reused."""
+    reused = Gauge('scenario_reused', 'Scenario not run again, reported as it went when the live meeting was built',
+                   ['backend', 'scenario'], registry=registry)
+    for slug, (success, duration) in samples.items():
+        description = SCENARIO_DESCRIPTIONS[slug]
+        Gauge(f'{slug}_success', f'Success of {description}', ['backend'], registry=registry).labels(hostname).set(success)
+        Gauge(f'{slug}_duration_seconds', f'Duration of {description}', ['backend'], registry=registry).labels(hostname).set(duration)
+        reused.labels(hostname, slug).set(1)
+
+
+def record_outcomes(registry, hostname, graph, budgets=None):
+    """Add the kinds of failures, the skipped scenarios and the time budgets of the steps to the registry."""
+    failures = Gauge('scenario_failure_info', 'Kind of failure of a failed scenario', ['backend', 'scenario', 'kind'], registry=registry)
+    for name, kind in graph.failures.items():
+        failures.labels(hostname, name, kind).set(1)
+        SCENARIO_FAILURES.labels(kind).inc()
+    skipped = Gauge('scenario_skipped', 'Scenario skipped because an earlier failure kept it from succeeding',
+                    ['backend', 'scenario', 'cause'], registry=registry)
+    for name, cause in graph.skipped.items():
+        skipped.labels(hostname, name, cause).set(1)
+        SCENARIO_SKIPS.labels(cause).inc()
+    if budgets:
+        budget = Gauge('probe_step_budget_seconds', 'Time a step may take, learned from its recent successful runs',
+                       ['backend', 'step'], registry=registry)
+        for step, seconds in sorted(budgets.budgets().items()):
+            budget.labels(hostname, step).set(seconds)
+
+
+def record_selectors(registry, hostname, selectors):
+    """Add the variants of the selectors that found the elements of the client, and its version, to the registry."""
+    variants = Gauge('selector_variant_info', 'Selector variant that last found an element of the BBB client',
+                     ['backend', 'selector', 'variant'], registry=registry)
+    for name, variant in sorted(selectors.matched.items()):
+        variants.labels(hostname, name, variant).set(1)
+    if selectors.version:
+        Gauge('bbb_client_version_info', 'Version of the BBB client', ['backend', 'version'],
+              registry=registry).labels(hostname, selectors.version).set(1)
+
+
+def stream_scenario(registry, name, progress):
+    """Hand the success and duration of a finished scenario to progress as an exposition of its own."""
+    if progress is None:
+        return
+    try:
+        progress(generate_latest(registry.restricted_registry([f'{name}_success', f'{name}_duration_seconds'])))
+    except Exception as exc:
+        # the final result still has it
+        log.debug(exc, exc_info=True)
+
+
+def collect(hostname, secret, pool=None, parallel=False, api_options=None, profile=None, live=None, budgets=None,
+            selectors=None, progress=None, **driver_options):
+    if live is not None:
+        registry = check_live(hostname, live)
+        if registry is not None:
+            return registry
+
+    selectors = Selectors() if selectors is None else selectors
+
+    registry = CollectorRegistry(auto_describe=True)
+    
+    labelnames = ['backend']
+    labelvalues = (hostname)
+    scenario_metrics = dict()
+
+    def make_gauges(slug):
+        description = SCENARIO_DESCRIPTIONS[slug]
+        success = Gauge(f'{slug}_success', f'Success of {description}', labelnames, registry=registry)
+        duration = Gauge(f'{slug}_duration_seconds', f'Duration of {description}', labelnames, registry=registry)
+        scenario_metrics[slug] = (success, duration)
+        success.labels(labelvalues).set(False)
+        duration.labels(labelvalues).set(0)
+        return Gauges(success.labels(labelvalues), duration.labels(labelvalues))
+
+    graph = ScenarioGraph(parallel)
+
+    @graph.scenario(kind='client')
+    @bbb_scenario(make_gauges('connect_server'))
     def connect_server(conn):
-        conn.join()
+        conn.join(room.join_url('selenium'))
+        record_page_timing(registry, hostname, conn)
 
-    @bbb_scenario(make_gauges('echo_test', 'waiting for echo test'))
+    @graph.scenario(requires=['connect_server'], fallback=lambda conn: conn.enter_without_audio(), kind='media')
+    @bbb_scenario(make_gauges('echo_test'))
     def echo_test(conn):
         conn.enter_with_mic()
         conn.wait_for_echo_test()
 
-    @bbb_scenario(make_gauges('join_headphone', 'joining room with headphones'))
+    @graph.scenario(requires=['connect_server'], kind='media')
+    @bbb_scenario(make_gauges('join_headphone'))
     def join_headphone(conn):
         with conn.window(1):
             conn.enter_with_headphones()
 
-    @bbb_scenario(make_gauges('start_cam', 'starting camera'))
+    @graph.scenario('camera', requires=['connect_server'], kind='media')
+    @bbb_scenario(make_gauges('start_cam'))
     def start_cam(conn):
         conn.wait_for_overlays_to_disappear()
         conn.switch_on_video()
         with conn.window(1):
             conn.check_for_video()
+            record_webrtc_stats(registry, hostname, conn)
 
-    @bbb_scenario(make_gauges('upload_pres', 'uploading presentation'))
+    @graph.scenario(requires=['connect_server'])
+    @bbb_scenario(make_gauges('upload_pres'))
     def upload_pres(conn):
         conn.upload_presentation()
 
-    @bbb_scenario(make_gauges('chat_test', 'testing chat'))
+    @graph.scenario('chat', requires=['connect_server'])
+    @bbb_scenario(make_gauges('chat_test'))
     def chat_test(conn):
         conn.send_chat_message()
         with conn.window(1):
             conn.check_for_chat_message()
 
-    @bbb_scenario(make_gauges('poll_test', 'testing poll'))
+    @graph.scenario(after=['upload_pres'], requires=['connect_server'])
+    @bbb_scenario(make_gauges('poll_test'))
     def poll_test(conn):
         conn.start_poll()
         with conn.window(1):
             conn.check_for_poll()
 
-    @bbb_scenario(make_gauges('etherpad_test', 'testing etherpad'))
+    @graph.scenario('etherpad', requires=['connect_server'])
+    @bbb_scenario(make_gauges('etherpad_test'))
     def etherpad_test(conn):
         conn.edit_etherpad()
         with conn.window(1):
             conn.check_for_etherpad()
 
+    selected = graph.select(profile.scenarios if profile else None)
+    for slug, metrics in scenario_metrics.items():
+        if slug not in selected:
+            # scenarios left out by the profile are not reported at all
+            for metric in metrics:
+                registry.unregister(metric)
+    record_profile(registry, hostname, profile)
+
+    probe_duration = Gauge('probe_duration_seconds', 'Duration of all scenarios along the critical path',
+                           labelnames, registry=registry).labels(labelvalues)
+    probe_duration.set(0)
 
     try:
-        with Meeting(hostname, secret) as room, BBBDriver(room.join_url('selenium'), headless=headless) as conn:
-            if not connect_server(conn):
-                return
-            
-            if not echo_test(conn):
-                conn.enter_without_audio()
+        with ExitStack() as sessions:
+            room = sessions.enter_context(Meeting(hostname, secret, **(api_options or {})))
+            sessions_lock = Lock()
+            conns = dict()
+
+            def open_lane(lane):
+                session = pool.session() if pool else BBBDriver(**driver_options)
+                conn = session.__enter__()
+                conn.budgets = budgets
+                conn.selectors = selectors
+                with sessions_lock:
+                    sessions.push(session.__exit__)
+                    conns[lane] = conn
+                if lane != MAIN_LANE:
+                    # The main lane joins first and stays presenter, the
+                    # other lanes join as additional users without audio.
+                    conn.join(room.join_url(f'selenium-{lane}'))
+                    conn.enter_without_audio()
+                    with conn.window(1):
+                        conn.enter_without_audio()
+                return conn
+
+            start = time.monotonic()
+            with probe_duration.time():
+                results = graph.run(open_lane, selected, lambda name: stream_scenario(registry, name, progress))
 
-            join_headphone(conn)
-            start_cam(conn)
-            upload_pres(conn)
-            chat_test(conn)
-            poll_test(conn)
-            etherpad_test(conn)
+            if live is not None and all(results.get(name) for name in LIVE_SCENARIOS):
+                video_conn = conns[graph.scenarios['start_cam'].lane]
+                meeting = LiveMeeting(room, sessions.pop_all(), conns[graph.scenarios['chat_test'].lane], video_conn,
+                                      time.monotonic() - start)
+                meeting.scenarios = scenario_samples(registry, hostname)
+                try:
+                    with video_conn.window(1):
+                        meeting.frames = video_conn.frames_decoded()
+                except Exception as exc:
+                    log.debug(exc, exc_info=True)
+                live.keep(hostname, meeting)
 
     except Exception as exc:
         log.exception(exc)
+        # e.g. the meeting could not be created, so the scenarios never ran
+        kind = classify(exc) or 'unreachable'
+        for name in selected - set(graph.results):
+            if graph.scenarios[name].requires:
+                graph.skipped[name] = kind
+            else:
+                graph.failures[name] = kind
     finally:
+        record_outcomes(registry, hostname, graph, budgets)
+        record_selectors(registry, hostname, selectors)
         return registry
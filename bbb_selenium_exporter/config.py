@@ -0,0 +1,161 @@
+import os
+import time
+from collections import namedtuple
+from threading import Event, Thread
+
+from prometheus_client import Counter, Gauge
+
+from .collect import PROFILES, SCENARIOS, Profile
+
+
+WATCH_INTERVAL = 5
+DEFAULT_SCHEDULE = 'full'
+
+# schedule is the cycle of profiles successive probes of the host run, profile
+# the one chosen for a single probe and state what earlier probes of the host
+# learned, which the exporter hands to the worker running the probe
+Target = namedtuple('Target', ['host', 'secret', 'interval', 'schedule', 'profile', 'state'], defaults=[None, (), None, None])
+
+CONFIG_RELOADS = Counter('config_reloads_total', 'Reloads of the targets file', ['result'])
+CONFIG_RELOAD_DURATION = Gauge('config_last_reload_duration_seconds', 'Duration of the last reload of the targets file')
+CONFIG_TARGET_CHANGES = Counter('config_target_changes_total', 'Targets changed by reloads of the targets file', ['change'])
+CONFIG_TARGETS = Gauge('config_targets', 'Targets configured in the targets file')
+
+
+def parse_schedule(spec, profiles):
+    """Turn a schedule like "light*3,full" into the cycle of profiles it stands for."""
+    schedule = []
+    for item in spec.split(','):
+        name, _, count = item.partition('*')
+        if name not in profiles:
+            raise ValueError(f'unknown profile {name}')
+        schedule.extend([profiles[name]] * (int(count) if count else 1))
+    return tuple(schedule)
+
+
+def read_config(path, default_schedule=DEFAULT_SCHEDULE):
+    with open(path, 'r') as config_file:
+        lines = config_file.readlines()
+
+    profiles = dict(PROFILES)
+    for linenum, line in enumerate(lines):
+        if not line.startswith('@profile '):
+            continue
+        _, name, *scenarios = line.split()
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            print(f'unknown scenarios {", ".join(sorted(unknown))} in line {linenum+1}, ignoring')
+            continue
+        profiles[name] = Profile(name, tuple(scenarios))
+
+    default_schedule = parse_schedule(default_schedule, profiles)
+
+    targets = dict()
+    for linenum, line in enumerate(lines):
+        host, _, rest = line.strip().partition(' ')
+        secret, _, rest = rest.strip().partition(' ')
+        if not secret or host.startswith(('#', '@')):
+            continue
+        if host in targets:
+            print(f'duplicate host {host} configured in line {linenum+1}, ignoring')
+            continue
+        interval, _, schedule = rest.strip().partition(' ')
+        if interval and not interval.isdigit() and not schedule:
+            # the interval may be left out in front of a schedule
+            interval, schedule = None, interval
+        try:
+            interval = int(interval) if interval else None
+        except ValueError:
+            print(f'invalid interval {interval} configured in line {linenum+1}, ignoring')
+            continue
+        try:
+            schedule = parse_schedule(schedule.strip(), profiles) if schedule.strip() else default_schedule
+        except ValueError as exc:
+            print(f'invalid schedule {schedule} configured in line {linenum+1}: {exc}, ignoring')
+            continue
+        targets[host] = Target(host, secret, interval, schedule)
+
+    return targets.values()
+
+
+def diff_targets(old, new):
+    """Compare two mappings of host to target, returning the added, removed and updated targets."""
+    added = [target for host, target in new.items() if host not in old]
+    removed = [target for host, target in old.items() if host not in new]
+    updated = [target for host, target in new.items() if host in old and old[host] != target]
+    return added, removed, updated
+
+
+class ConfigWatcher():
+    """Reloads the targets file whenever it changed or reload() was called.
+
+    Changes are noticed by polling the modification time, size and inode of
+    the file, so editors replacing the file are covered as well. Reloading
+    happens in a thread of its own and on_change is only called with the
+    new targets if any target was added, removed or updated.
+    """
+
+    def __init__(self, path, on_change, interval=WATCH_INTERVAL, default_schedule=DEFAULT_SCHEDULE):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.default_schedule = default_schedule
+        self._targets = dict()
+        self._stat = None
+        self._wakeup = Event()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Load the targets file for the first time and start watching it."""
+        self._load()
+        self._thread.start()
+
+    def reload(self):
+        """Reload the targets file soon, even if it looks unchanged. Safe to call from signal handlers."""
+        self._stat = None
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            if self._file_stat() != self._stat:
+                self._load()
+
+    def _load(self):
+        start = time.monotonic()
+        self._stat = self._file_stat()
+        try:
+            targets = {target.host: target for target in read_config(self.path, self.default_schedule)}
+        except (OSError, ValueError) as exc:
+            print(f'failed to read targets from {self.path}: {exc}')
+            CONFIG_RELOADS.labels('failure').inc()
+            return
+
+        added, removed, updated = diff_targets(self._targets, targets)
+        if added or removed or updated:
+            print(f'targets reloaded: {len(added)} added, {len(removed)} removed, {len(updated)} updated')
+            self._targets = targets
+            self.on_change(list(targets.values()))
+
+        CONFIG_TARGET_CHANGES.labels('added').inc(len(added))
+        CONFIG_TARGET_CHANGES.labels('removed').inc(len(removed))
+        CONFIG_TARGET_CHANGES.labels('updated').inc(len(updated))
+        CONFIG_TARGETS.set(len(targets))
+        CONFIG_RELOADS.labels('success').inc()
+        CONFIG_RELOAD_DURATION.set(time.monotonic() - start)
@@ -0,0 +1,108 @@
+"""Aggregates the durations and results of scenarios across probes.
+
+A probe reports only how its last run of every scenario went. To keep latency
+spikes between two scrapes, the parent process accumulates them per host
+into histograms of the successful runs with fixed buckets and counters of
+successful and failed runs, which need a constant amount of memory per host
+no matter how many probes ran.
+"""
+
+from threading import Lock
+
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.metrics_core import CounterMetricFamily, HistogramMetricFamily
+from prometheus_client.parser import text_string_to_metric_families
+
+
+BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+
+def scenario_results(payload):
+    """Find the scenarios of an exposition, returning their result and duration by name.
+
+    The result is one of success, failure and skipped. Scenarios reused from
+    the probe that built a live meeting did not run again and are left out.
+    """
+    values = dict()
+    skipped = set()
+    reused = set()
+    for family in text_string_to_metric_families(payload.decode()):
+        for sample in family.samples:
+            values[sample.name] = sample.value
+            if sample.name == 'scenario_skipped' and sample.value:
+                skipped.add(sample.labels['scenario'])
+            elif sample.name == 'scenario_reused' and sample.value:
+                reused.add(sample.labels['scenario'])
+    results = dict()
+    for name, value in values.items():
+        slug = name[:-len('_success')]
+        if name.endswith('_success') and f'{slug}_duration_seconds' in values and slug not in reused:
+            result = 'success' if value else 'skipped' if slug in skipped else 'failure'
+            results[slug] = (result, values[f'{slug}_duration_seconds'])
+    return results
+
+
+class _Scenario():
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.results = {'success': 0, 'failure': 0, 'skipped': 0}
+
+
+class History():
+    """Scenario histograms and counters of every host since the exporter started."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = sorted(buckets)
+        self._scenarios = dict()
+        self._lock = Lock()
+
+    def record(self, host, payload):
+        """Add the scenarios of a probe result and return the rendered history of the host."""
+        results = scenario_results(payload)
+        with self._lock:
+            scenarios = self._scenarios.setdefault(host, dict())
+            for name, (result, duration) in results.items():
+                scenario = scenarios.setdefault(name, _Scenario(self.buckets))
+                scenario.results[result] += 1
+                if result == 'success':
+                    # failures mostly take their full timeouts, which would distort the latencies
+                    scenario.counts[self._bucket(duration)] += 1
+                    scenario.sum += duration
+            return self._render(host, scenarios)
+
+    def forget(self, host):
+        with self._lock:
+            self._scenarios.pop(host, None)
+
+    def _bucket(self, duration):
+        for num, bound in enumerate(self.buckets):
+            if duration <= bound:
+                return num
+        return len(self.buckets)
+
+    def _render(self, host, scenarios):
+        if not scenarios:
+            return b''
+        durations = HistogramMetricFamily('scenario_duration_seconds', 'Durations of successful scenario runs', labels=['backend', 'scenario'])
+        runs = CounterMetricFamily('scenario_runs', 'Finished scenario runs', labels=['backend', 'scenario', 'result'])
+        for name, scenario in sorted(scenarios.items()):
+            cumulative, buckets = 0, []
+            for bound, count in zip(self.buckets + [float('inf')], scenario.counts):
+                cumulative += count
+                buckets.append((str(float(bound)) if bound != float('inf') else '+Inf', cumulative))
+            durations.add_metric([host, name], buckets, scenario.sum)
+            for result, count in scenario.results.items():
+                runs.add_metric([host, name, result], count)
+
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(_Families([durations, runs]))
+        return generate_latest(registry)
+
+
+class _Families():
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
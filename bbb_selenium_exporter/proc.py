@@ -0,0 +1,53 @@
+"""Helpers to inspect process trees using /proc."""
+
+import os
+
+
+def stat(pid):
+    """Return the parent pid and session id of a process."""
+    with open(f'/proc/{pid}/stat') as stat_file:
+        fields = stat_file.read().rpartition(')')[2].split()
+    return int(fields[1]), int(fields[3])
+
+
+def children():
+    """Map the pid of every process to the pids of its children."""
+    result = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid, _ = stat(entry)
+        except (OSError, ValueError, IndexError):
+            continue
+        result.setdefault(ppid, []).append(int(entry))
+    return result
+
+
+def tree_rss(root, children_map=None):
+    """Resident memory of a process and all its descendants in bytes."""
+    if children_map is None:
+        children_map = children()
+    rss = 0
+    pending = [root]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children_map.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/statm') as statm:
+                rss += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            continue
+    return rss
+
+
+def cpu_seconds(pid):
+    """User and system CPU time a process used so far."""
+    with open(f'/proc/{pid}/stat') as stat_file:
+        fields = stat_file.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def name(pid):
+    with open(f'/proc/{pid}/comm') as comm:
+        return comm.read().strip()
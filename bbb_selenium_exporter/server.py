@@ -1,110 +1,655 @@
+import gzip
+import heapq
+import json
+import math
 import os
 import signal
 import sys
 import time
 from argparse import ArgumentParser
-from collections import namedtuple
+from contextlib import nullcontext
+from collections import OrderedDict, namedtuple
 from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread, Timer, Lock
-from urllib.parse import parse_qs, urlparse
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Thread, Lock
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+from . import spans, telemetry
+from .bbb import API_RETRIES, API_TIMEOUT
+from .apiprobe import ApiProber
+from .cluster import FORWARDED_HEADER, HEALTH_PATH, Cluster
+from .config import DEFAULT_SCHEDULE, WATCH_INTERVAL, ConfigWatcher, diff_targets
+from .collect import (LAUNCH_PROFILES, PIXEL_MODES, WAIT_MODES, DriverPool, LiveMeetings, Selectors, StepBudgets, collect, fake_collect,
+                      probe_succeeded, probe_unreachable, unfinished_probe)
+from .history import BUCKETS, History
+from .supervisor import WorkerPool
+
+
+REQUEST_TIMEOUT = 30
+SNAPSHOT_INTERVAL = 60
+
+PARTS = ('browser', 'progress', 'api', 'history')
+
+# retry tells whether the host should be probed again after the retry interval,
+# live the hosts whose meetings the worker keeps alive afterwards
+Result = namedtuple('Result', ['target', 'payload', 'ok', 'timestamp', 'telemetry', 'trace', 'retry', 'live'],
+                    defaults=[None, False, ()])
+# the exposition of a scenario finished by a probe still running
+Progress = namedtuple('Progress', ['target', 'payload'])
+# what the probes of a host learned, kept by the exporter and passed along with every probe
+ProbeState = namedtuple('ProbeState', ['budgets', 'selectors'])
+
+
+def split_families(payload):
+    """Split a text exposition into its metric families.
+
+    Returns an ordered mapping of family name to its HELP/TYPE header and its
+    samples, so expositions can be merged without parsing them again.
+    """
+    families = OrderedDict()
+    header, samples = [], []
+    for line in payload.splitlines(keepends=True):
+        if line.startswith((b'# HELP ', b'# TYPE ')):
+            name = line.split(b' ', 3)[2]
+            if name not in families:
+                families[name] = header, samples = [], []
+            header.append(line)
+        elif line.strip():
+            if not families:
+                families[b''] = header, samples
+            samples.append(line)
+    return OrderedDict((name, (b''.join(header), b''.join(samples))) for name, (header, samples) in families.items())
+
+
+def render_families(families):
+    return b''.join(header + samples for header, samples in families.values())
+
+
+def progress_part(host, running):
+    registry = CollectorRegistry()
+    Gauge('probe_in_progress', 'Whether a browser probe is running, whose finished scenarios are reported already',
+          ['backend'], registry=registry).labels(host).set(running)
+    return generate_latest(registry)
+
+
+def merge_families(family_maps):
+    """Render several split expositions as one, with a single header per family."""
+    merged = OrderedDict()
+    for families in family_maps:
+        for name, (header, samples) in families.items():
+            if name in merged:
+                merged[name][1].append(samples)
+            else:
+                merged[name] = (header, [samples])
+    return b''.join(header + b''.join(samples) for header, samples in merged.values())
+
+
+class CacheEntry(namedtuple('CacheEntry', ['generation', 'timestamp', 'parts', 'identity', 'gzip', 'families'])):
+    """A probe result, pre-rendered in every content coding we serve.
+
+    The exposition is made up of one part per probe tier (see PARTS), the
+    timestamp is the time of the last browser probe, if there was one. A
+    metric family in a later part replaces the one of an earlier part, e.g.
+    the scenarios a running probe streamed those of its last result.
+    """
+
+    @classmethod
+    def create(cls, generation, timestamp, parts):
+        families = OrderedDict()
+        for part in PARTS:
+            if part in parts:
+                families.update(split_families(parts[part]))
+        return cls.from_families(generation, timestamp, parts, families)
+
+    @classmethod
+    def from_families(cls, generation, timestamp, parts, families):
+        """An entry for parts whose exposition was split into families already."""
+        identity = render_families(families)
+        return cls(generation, timestamp, parts, identity, gzip.compress(identity), families)
+
+    @classmethod
+    def merged(cls, generation, identity):
+        """An exposition combining the results of several hosts."""
+        return cls(generation, None, dict(), identity, gzip.compress(identity), None)
+
+    def etag(self, gzipped=False):
+        return f'"{self.generation:x}-{int((self.timestamp or 0) * 1000):x}{"-gzip" if gzipped else ""}"'
+
+    def matches(self, if_none_match):
+        tags = {tag.strip().replace('W/', '', 1) for tag in (if_none_match or '').split(',')}
+        return bool(tags & {'*', self.etag(), self.etag(gzipped=True)})
+
+
+class HostFamilies():
+    """The metric families of several hosts, with the samples of every host kept apart.
+
+    Replacing the results of a host only touches its own samples, so the
+    merged exposition is rendered by joining parts that are ready already.
+    """
+
+    def __init__(self):
+        self._families = OrderedDict()
+        self._hosts = dict()
+
+    def update(self, host, families):
+        self.remove(host)
+        for name, (header, samples) in families.items():
+            if name not in self._families:
+                self._families[name] = (header, dict())
+            self._families[name][1][host] = samples
+        self._hosts[host] = list(families)
+
+    def remove(self, host):
+        for name in self._hosts.pop(host, ()):
+            samples = self._families[name][1]
+            del samples[host]
+            if not samples:
+                del self._families[name]
+
+    def hosts(self):
+        return set(self._hosts)
+
+    def render(self):
+        return b''.join(header + b''.join(samples[host] for host in sorted(samples))
+                        for header, samples in self._families.values())
 
-from mpipe import UnorderedStage, Pipeline
-from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from .collect import collect
+SCHEDULER_QUEUE_DEPTH = Gauge('scheduler_queue_depth', 'Due targets waiting for an idle worker')
+SCHEDULER_LAG = Histogram('scheduler_lag_seconds', 'Delay between the planned and actual start of a probe',
+                          buckets=(0.1, 1, 5, 15, 30, 60, 120, 300, 600, 900, float('inf')))
+SCHEDULER_MISSED_DEADLINES = Counter('scheduler_missed_deadlines_total', 'Probes skipped because the previous one was late')
 
+STARTUP_FIRST_SERVE = Gauge('startup_first_serve_seconds', 'Time from startup until the first probe result was served')
+_started = time.monotonic()
+_first_served = Event()
 
-Target = namedtuple('Target', ['host', 'secret']) 
 
-
-class Repeater(Timer):
-    def run(self):
-        self.function(*self.args, **self.kwargs)
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+def record_first_serve():
+    if not _first_served.is_set():
+        _first_served.set()
+        STARTUP_FIRST_SERVE.set(time.monotonic() - _started)
 
 
 class Scheduler():
-    def __init__(self, runner):
+    """Hands due targets to the runner from a single thread.
+
+    Every host gets a fixed phase within its interval derived from a hash of
+    its name, so probes are spread evenly instead of all firing at once. New
+    hosts are probed right away, those without any result or with the oldest
+    result first, and fall into their phase afterwards. No more targets are
+    handed out than there are idle workers, and hosts whose last probe failed
+    are probed again after the retry interval. Successive probes of a host
+    cycle through the profiles of its schedule.
+    """
+
+    def __init__(self, runner, capacity):
         self.runner = runner
+        self.capacity = capacity
         self.targets = dict()
-
-    def add(self, target):
-        timer = Repeater(self.interval, lambda: self.runner.put(target))
-        self.targets[target] = timer
-        timer.start()
+        self._due = dict()
+        self._queue = []
+        self._in_flight = set()
+        self._probes = dict()
+        self._epoch = time.monotonic()
+        self._depth_updated = 0
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _interval(self, target):
+        return target.interval or self.interval
+
+    def _next_slot(self, target, now):
+        # first slot of the host's phase at least half an interval from now
+        interval = self._interval(target)
+        phase = int(sha1(target.host.encode()).hexdigest(), 16) % int(interval * 1000) / 1000
+        cycles = math.floor((now + interval / 2 - self._epoch - phase) / interval) + 1
+        return self._epoch + phase + cycles * interval
+
+    def _with_profile(self, target):
+        if not target.schedule:
+            return target
+        num = self._probes.get(target.host, 0)
+        self._probes[target.host] = num + 1
+        return target._replace(profile=target.schedule[num % len(target.schedule)])
+
+    def _push(self, host, due, rank=0):
+        self._due[host] = due
+        heapq.heappush(self._queue, (due, rank, host))
+        self._cond.notify()
+
+    def add(self, target, last_probe=None):
+        """Schedule a new target, last_probe being the Unix time of a result we already have."""
+        with self._cond:
+            self.targets[target.host] = target
+            now = time.monotonic()
+            if last_probe is None:
+                self._push(target.host, now, -math.inf)
+            else:
+                age = max(0, time.time() - last_probe)
+                self._push(target.host, max(now, now + self._interval(target) - age), -age)
+
+    def update(self, target):
+        """Replace the secret, interval or schedule of a scheduled target without probing it again early."""
+        with self._cond:
+            old = self.targets[target.host]
+            self.targets[target.host] = target
+            if self._interval(old) != self._interval(target):
+                self._push(target.host, self._next_slot(target, time.monotonic()))
 
     def remove(self, target):
-        try:
-            self.targets[target].cancel()
-            del self.targets[target]
-        except KeyError:
-            pass
+        with self._cond:
+            if target.host in self.targets:
+                del self.targets[target.host]
+                del self._due[target.host]
+                self._probes.pop(target.host, None)
+
+    def done(self, target, retry=False):
+        """Free the worker of a finished probe and schedule a retry if asked to.
+
+        Only probes that could not reach the server at all are retried early.
+        A broken feature would fail every retry just the same, each costing
+        a full probe.
+        """
+        with self._cond:
+            self._in_flight.discard(target.host)
+            self._cond.notify()
+            if not retry or target.host not in self.targets:
+                return
+            retry = time.monotonic() + self.retry_interval
+            if retry < self._due[target.host]:
+                self._push(target.host, retry)
 
     def cancel_all(self):
-        for target, timer in self.targets.items():
-            timer.cancel()
-            del self.targets[target]
+        with self._cond:
+            self._stopped = True
+            self.targets.clear()
+            self._due.clear()
+            self._probes.clear()
+            self._cond.notify()
+        self._thread.join()
+
+    def _waiting(self, now):
+        return sum(1 for due, _, host in self._queue if due <= now and self._due.get(host) == due)
+
+    def _run(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                if now - self._depth_updated >= 1:
+                    # counting takes a pass over the whole queue, so don't do it on every wakeup
+                    SCHEDULER_QUEUE_DEPTH.set(self._waiting(now))
+                    self._depth_updated = now
+
+                if self._queue and self._due.get(self._queue[0][2]) != self._queue[0][0]:
+                    heapq.heappop(self._queue)
+                    continue
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, _, host = self._queue[0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                if host in self._in_flight:
+                    # the previous probe of this host is still running
+                    heapq.heappop(self._queue)
+                    SCHEDULER_MISSED_DEADLINES.inc()
+                    self._push(host, self._next_slot(self.targets[host], now))
+                    continue
+                if len(self._in_flight) >= self.capacity:
+                    self._cond.wait()
+                    continue
+
+                heapq.heappop(self._queue)
+                target = self.targets[host]
+                lag = now - due
+                SCHEDULER_LAG.observe(lag)
+                SCHEDULER_MISSED_DEADLINES.inc(int(lag // self._interval(target)))
+                self._in_flight.add(host)
+                self._push(host, self._next_slot(target, now))
+                self.runner.put(self._with_profile(target))
+
+    @staticmethod
+    def factory(interval, retry_interval):
+        return type('Scheduler', (Scheduler, object), {'interval': interval, 'retry_interval': retry_interval})
+
+
+class SeleniumWorker():
+    def doInit(self):
+        telemetry.start_buffering()
+        self.pool = DriverPool(self.pool_size, self.max_uses, self.max_rss, **self.driver_options)
+        self.pool.fill()
+        self.live = LiveMeetings(self.live_meetings, self.live_max_age) if self.live_meetings else None
+
+    def doTask(self, target):
+        if target is None:
+            if self.live:
+                self.live.close()
+            self.pool.close()
+            return None
+        # the state goes back with the result, including what this probe learned
+        state = target.state or ProbeState(StepBudgets(self.timeout_factor) if self.timeout_factor else None, Selectors())
+        target = target._replace(state=state)
+        with spans.recording(self.profile) if self.trace else nullcontext() as trace:
+            registry = self.collector(target.host, target.secret, pool=self.pool, parallel=self.parallel, api_options=self.api_options,
+                                      profile=target.profile, live=self.live, budgets=state.budgets, selectors=state.selectors,
+                                      progress=lambda payload: self.report(Progress(target._replace(state=None), payload)))
+            timestamp = time.time()
+            Gauge('probe_timestamp_seconds', 'Unix time the probe finished', ['backend'], registry=registry).labels(target.host).set(timestamp)
+            with spans.span('serialize'):
+                payload = generate_latest(registry)
+        return Result(target, payload, probe_succeeded(registry), timestamp, telemetry.drain(), trace.to_dict() if trace else None,
+                      probe_unreachable(registry), self.live.hosts() if self.live else ())
+
+    def doAfterTask(self):
+        # replacing the browsers quit by the probe is no part of it
+        self.pool.fill()
+
+    @staticmethod
+    def affinity(target):
+        return target.host
 
     @staticmethod
-    def factory(interval):
-        return type('Scheduler', (Scheduler, object), {'interval': interval})
+    def pinned(result):
+        """Probes of a host whose meeting a worker keeps alive wait for that worker.
+
+        Another worker would create a second meeting for the host.
+        """
+        return result.live
+
+    @staticmethod
+    def failed(target, reason='died'):
+        """The result of a probe whose worker was killed or died, with all scenarios failed."""
+        registry = unfinished_probe(target.host, target.profile, reason)
+        timestamp = time.time()
+        Gauge('probe_timestamp_seconds', 'Unix time the probe finished', ['backend'], registry=registry).labels(target.host).set(timestamp)
+        # a worker that crashed may well succeed next time, unlike a probe that is too slow or too big
+        return Result(target, generate_latest(registry), False, timestamp, [], retry=reason == 'died')
+
+    @staticmethod
+    def factory(parallel, pool_size, max_uses, max_rss, api_options, dry_run=False, trace=False, profile=False,
+                live_meetings=0, live_max_age=3600, timeout_factor=0, **driver_options):
+        return type('SeleniumWorker', (SeleniumWorker, object), {
+            'api_options': api_options,
+            'trace': trace or profile,
+            'profile': profile,
+            'collector': staticmethod(fake_collect if dry_run else collect),
+            'driver_options': driver_options,
+            'parallel': parallel,
+            'pool_size': 0 if dry_run else pool_size,
+            'max_uses': max_uses,
+            'max_rss': max_rss,
+            'live_meetings': live_meetings,
+            'live_max_age': live_max_age,
+            'timeout_factor': timeout_factor,
+        })
 
 
 class ExecutionCache():
-    def __init__(self, function, jobs, SchedulerClass):
+    def __init__(self, worker, jobs, SchedulerClass, PoolClass=WorkerPool, snapshot=None, history=None):
         self._results = dict()
-        self._targets = set()
+        self._traces = dict()
+        # the scenarios streamed by running probes, by host
+        self._streamed = dict()
+        # the state of the last probe of every host, see ProbeState
+        self._states = dict()
+        self._targets = dict()
         self._update_lock = Lock()
-
-        self._runner = Pipeline(UnorderedStage(function, jobs))
+        self._publish_lock = Lock()
+        self._generation = 0
+        self._merged = None
+        # the families of all results as merged last, and the generation of every result in there
+        self._merge_lock = Lock()
+        self._merged_families = HostFamilies()
+        self._merged_generations = dict()
+        self._snapshot = snapshot
+        self._history = history
+        self._dirty = Event()
+        self._stopped = Event()
+
+        if snapshot:
+            self.load_snapshot()
+            self._writer = Thread(target=self._write_snapshots, daemon=True)
+            self._writer.start()
+
+        self._runner = PoolClass(worker, jobs)
 
         def fetch():
-            for target, result in self._runner.results():
-                if target in self._targets:
-                    self._results[target.host] = result
-                else:
-                    print(f'dropping obsolete result for {target}')
+            for result in self._runner.results():
+                if isinstance(result, Progress):
+                    self.publish_progress(result.target.host, result.payload)
+                    continue
+                with spans.span('handle_result'):
+                    telemetry.apply(result.telemetry)
+                    self.scheduler.done(result.target, result.retry)
+                    streamed = self._streamed.pop(result.target.host, None)
+                    if result.payload is None:
+                        continue
+                    if result.target.host not in self._targets:
+                        print(f'dropping obsolete result for {result.target}')
+                        continue
+                    if result.target.state is not None:
+                        self._states[result.target.host] = result.target.state
+                    if result.trace:
+                        self._traces[result.target.host] = result.trace
+                    payload = result.payload
+                    if streamed and not result.ok:
+                        # scenarios finished before the worker was killed are kept
+                        families = split_families(payload)
+                        families.update(streamed)
+                        payload = render_families(families)
+                    self.publish(result.target.host, 'browser', payload, result.timestamp)
         
+        self.scheduler = SchedulerClass(self, jobs)
         self._fetcher = Thread(target=fetch)
         self._fetcher.start()
-        self.scheduler = SchedulerClass(self._runner)
+
+    def put(self, target):
+        """Run a probe the scheduler found due, handing the state of the last probe of the host along.
+
+        Every worker may probe every host, so what the probes learned is kept
+        here instead of in the workers, where it would diverge and die with them.
+        """
+        self._runner.put(target._replace(state=self._states.get(target.host)))
 
     def teardown(self):
         self.scheduler.cancel_all()
         self._runner.put(None)
         self._fetcher.join()
+        if self._snapshot:
+            self._stopped.set()
+            self._writer.join()
+
+    def publish(self, host, part, payload, timestamp=None):
+        """Replace one part of the result of a host, timestamp being the time of a browser probe."""
+        history = self._history.record(host, payload) if self._history else None
+        with self._publish_lock:
+            if host not in self._targets:
+                if self._history:
+                    self._history.forget(host)
+                return
+            entry = self._results.get(host)
+            parts = dict(entry.parts) if entry else dict()
+            parts[part] = payload
+            if part == 'browser':
+                parts['progress'] = progress_part(host, False)
+            if history is not None:
+                parts['history'] = history
+            if timestamp is None and entry:
+                timestamp = entry.timestamp
+            self._generation += 1
+            self._results[host] = CacheEntry.create(self._generation, timestamp, parts)
+            self._dirty.set()
+
+    def publish_progress(self, host, payload):
+        """Merge the exposition of a scenario finished by a running probe into the result of a host.
+
+        Only the metric families in payload are replaced, the rest of the
+        last result stays as it is until the probe finished. The scenarios
+        streamed so far make up the progress part, so only they are rendered
+        again and spliced into the families of the last entry.
+        """
+        streamed = self._streamed.setdefault(host, OrderedDict())
+        streamed.update(split_families(payload))
+        progress = progress_part(host, True) + render_families(streamed)
+        with self._publish_lock:
+            entry = self._results.get(host)
+            if host not in self._targets:
+                return
+            parts = dict(entry.parts) if entry else dict()
+            parts['progress'] = progress
+            families = OrderedDict(entry.families) if entry else OrderedDict()
+            families.update(split_families(progress))
+            self._generation += 1
+            self._results[host] = CacheEntry.from_families(self._generation, entry.timestamp if entry else None, parts, families)
+            self._dirty.set()
+
+    def load_snapshot(self):
+        try:
+            with open(self._snapshot, 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            print(f'ignoring unreadable snapshot {self._snapshot}: {exc}')
+            return
+
+        try:
+            for host, entry in snapshot['results'].items():
+                parts = entry['parts'] if snapshot['version'] > 1 else {'browser': entry['payload']}
+                # probes running when the snapshot was written are gone
+                parts = {part: payload.encode() for part, payload in parts.items() if part != 'progress'}
+                self._results[host] = CacheEntry.create(entry['generation'], entry['timestamp'], parts)
+        except (KeyError, TypeError, AttributeError, ValueError) as exc:
+            print(f'ignoring malformed snapshot {self._snapshot}: {exc!r}')
+            self._results.clear()
+            return
+        self._generation = max((entry.generation for entry in self._results.values()), default=0)
+        print(f'loaded {len(self._results)} results from snapshot {self._snapshot}')
+
+    def save_snapshot(self):
+        self._dirty.clear()
+        results = {
+            host: {
+                'generation': entry.generation,
+                'timestamp': entry.timestamp,
+                'parts': {part: payload.decode() for part, payload in entry.parts.items()},
+            }
+            for host, entry in list(self._results.items())
+        }
+        # write to a temporary file first, so a crash never leaves a partial snapshot behind
+        tmp_path = f'{self._snapshot}.tmp'
+        try:
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump({'version': 2, 'results': results}, snapshot_file)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(tmp_path, self._snapshot)
+        except OSError as exc:
+            # e.g. a full disk, try again with the next interval
+            print(f'failed to write snapshot {self._snapshot}: {exc}')
+            self._dirty.set()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _write_snapshots(self):
+        while not self._stopped.wait(SNAPSHOT_INTERVAL):
+            if self._dirty.is_set():
+                self.save_snapshot()
+        self.save_snapshot()
 
     def update_targets(self, targets):
         with self._update_lock:
-            new_targets = set(targets)
-            old_targets = self._targets
+            new_targets = {target.host: target for target in targets}
+            added, removed, updated = diff_targets(self._targets, new_targets)
 
-            new_hosts = { target.host for target in targets }
-            old_hosts = { target.host for target in self._targets }
-            removed_hosts = old_hosts - new_hosts
-
-            self._targets = new_targets
-            
-            for target in old_targets - new_targets:
+            for target in removed:
                 self.scheduler.remove(target)
-
-                if target.host in removed_hosts:
-                    try:
-                        del self._results[target.host]
-                    except KeyError:
-                        pass
-
-            for target in new_targets - old_targets:
-                self.scheduler.add(target)
-
+                self._runner.forget(target)
+            # a new secret or interval applies from the next probe on, keeping the result
+            for target in updated:
+                self.scheduler.update(target)
+
+            with self._publish_lock:
+                # replaced as a whole, so readers never see a partial update
+                self._targets = new_targets
+                for host in set(self._traces) - set(new_targets):
+                    del self._traces[host]
+                for host in set(self._states) - set(new_targets):
+                    del self._states[host]
+                for host in set(self._results) - set(new_targets):
+                    del self._results[host]
+                    if self._history:
+                        self._history.forget(host)
+                    self._generation += 1
+                    self._dirty.set()
+
+            for target in added:
+                entry = self._results.get(target.host)
+                self.scheduler.add(target, entry.timestamp if entry else None)
+
+    def merged(self):
+        """The results of all hosts as one entry.
+
+        It is rendered again only after a result changed, and then only the
+        samples of the hosts whose results changed are replaced.
+        """
+        with self._publish_lock:
+            merged = self._merged
+            generation = self._generation
+            if merged is not None and merged.generation == generation:
+                return merged
+            results = dict(self._results)
+        with self._merge_lock:
+            merged = self._merged
+            if merged is not None and merged.generation >= generation:
+                return merged
+            for host in self._merged_families.hosts() - set(results):
+                self._merged_families.remove(host)
+                del self._merged_generations[host]
+            for host, entry in results.items():
+                if self._merged_generations.get(host) != entry.generation:
+                    self._merged_families.update(host, entry.families)
+                    self._merged_generations[host] = entry.generation
+            merged = CacheEntry.merged(generation, self._merged_families.render())
+        with self._publish_lock:
+            if self._merged is None or self._merged.generation < generation:
+                self._merged = merged
+        return merged
+
+    def trace(self, host):
+        """The trace of the last probe of a host, if probes are traced."""
+        return self._traces[host]
 
     def __getitem__(self, key):
         return self._results[key]
 
 
+def accepts_gzip(accept_encoding):
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            params = params.replace(' ', '')
+            try:
+                return not params.startswith('q=') or float(params[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
 class CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_TIMEOUT
+    # headers and body are written separately, which would otherwise wait
+    # for the delayed ACK of the client on kept alive connections
+    disable_nagle_algorithm = True
 
     HOME = b'''
     <!DOCTYPE html>
@@ -116,92 +661,265 @@ class CacheHandler(BaseHTTPRequestHandler):
     <h1>bbb-selenium-exporter</h1>
     Go to <a href="/metrics?target="><code>/metrics?target=HOST</a>
     to access the metrics.
+    Repeat the <code>target</code> parameter to get the metrics of several hosts at once,
+    or go to <a href="/metrics/all"><code>/metrics/all</code></a> for the metrics of all hosts.
+    The exporter's own metrics are available at <a href="/metrics"><code>/metrics</code></a>.
     </body>
     </html>
     '''
 
     @staticmethod
-    def factory(cache):
-        return type('CacheHandler', (CacheHandler, object), {"cache": cache})
+    def factory(cache, cluster=None, redirect=False):
+        return type('CacheHandler', (CacheHandler, object), {"cache": cache, "cluster": cluster, "redirect": redirect})
 
     def do_GET(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(self.HOME)
-            return
-        if not self.path.startswith('/metrics'):
+        url = urlparse(self.path)
+        if url.path == '/':
+            self.send_payload(self.HOME, 'text/html; charset=utf-8')
+        elif url.path == HEALTH_PATH:
+            self.send_payload(b'ok\n', 'text/plain; charset=utf-8')
+        elif url.path == '/metrics':
+            self.send_metrics(parse_qs(url.query).get('target', []))
+        elif url.path == '/metrics/all':
+            self.send_all()
+        elif url.path in ('/debug/probe', '/debug/profile'):
+            self.send_trace(url.path, parse_qs(url.query).get('target', [''])[0])
+        else:
             self.send_error(404)
-            return
-
-        try:
-            target = parse_qs(urlparse(self.path).query)['target'][0]
-        except KeyError:
-            self.send_error(400, 'query parameter "target" is missing')
-            return
 
-        try:
-            result = self.cache[target]
-        except KeyError:
-            self.send_error(404, 'unknown target')
+    def send_payload(self, payload, content_type, status=200, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if accepts_gzip(self.headers.get('Accept-Encoding')):
+            payload = gzip.compress(payload)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_entry(self, entry):
+        # /metrics/all is served before there are any results, just empty
+        if entry.identity:
+            record_first_serve()
+        gzipped = accepts_gzip(self.headers.get('Accept-Encoding'))
+        if entry.matches(self.headers.get('If-None-Match')):
+            self.send_response(304)
+            self.send_header('ETag', entry.etag(gzipped))
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
             return
 
+        payload = entry.gzip if gzipped else entry.identity
         self.send_response(200)
         self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('ETag', entry.etag(gzipped))
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
         self.end_headers()
-        self.wfile.write(result)
+        self.wfile.write(payload)
 
-def prepare_selenium_test(headless):
-    def run_selenium_test(target):
-        return target, generate_latest(collect(target.host, target.secret, headless=headless))
-    return run_selenium_test
+    def send_metrics(self, targets):
+        if not targets:
+            self.send_payload(generate_latest(), CONTENT_TYPE_LATEST)
+            return
 
+        if len(targets) == 1:
+            target = targets[0]
+            if self.cluster and FORWARDED_HEADER not in self.headers:
+                node = self.cluster.owner(target)
+                if node != self.cluster.me:
+                    self.forward(node)
+                    return
+            try:
+                entry = self.cache[target]
+            except KeyError:
+                self.send_error(404, 'unknown target')
+                return
+            self.send_entry(entry)
+            return
 
-def read_config(path):
-    with open(path, 'r') as config_file:
-        lines = config_file.readlines()
+        families = []
+        for target in dict.fromkeys(targets):
+            try:
+                families.append(self.lookup(target))
+            except KeyError:
+                continue
+        if not families:
+            self.send_error(404, 'unknown targets')
+            return
+        self.send_payload(merge_families(families), CONTENT_TYPE_LATEST)
 
-    targets = dict()
-    for linenum, line in enumerate(lines):
-        host, _, secret = line.strip().partition(' ')
-        if not secret or host.startswith('#'):
-            continue
-        if host in targets:
-            print(f'duplicate host {host} configured in line {linenum+1}, ignoring')
-            continue
-        targets[host] = Target(host, secret)
+    def send_all(self):
+        entry = self.cache.merged()
+        if not self.cluster or FORWARDED_HEADER in self.headers:
+            self.send_entry(entry)
+            return
 
-    return targets.values()
+        # every other node contributes the results of the targets it owns
+        families = [split_families(entry.identity)]
+        for node in self.cluster.peers():
+            try:
+                response = self.cluster.proxy(node, '/metrics/all')
+            except Exception as exc:
+                print(f'failed to get results of {node}: {exc}')
+                continue
+            if response.status_code == 200:
+                families.append(split_families(response.content))
+        self.send_payload(merge_families(families), CONTENT_TYPE_LATEST)
+
+    def send_trace(self, path, target):
+        if self.cluster and FORWARDED_HEADER not in self.headers:
+            node = self.cluster.owner(target)
+            if node != self.cluster.me:
+                self.forward(node)
+                return
+        try:
+            trace = self.cache.trace(target)
+        except KeyError:
+            self.send_error(404, 'no trace of target, enable --trace-probes')
+            return
+        if path == '/debug/probe':
+            self.send_payload(json.dumps(trace, indent=2).encode(), 'application/json')
+        elif trace['profile'] is not None:
+            self.send_payload(trace['profile'].encode(), 'text/plain; charset=utf-8')
+        else:
+            self.send_error(404, 'no profile of target, enable --profile-probes')
+
+    def lookup(self, target):
+        if self.cluster and FORWARDED_HEADER not in self.headers:
+            node = self.cluster.owner(target)
+            if node != self.cluster.me:
+                try:
+                    response = self.cluster.proxy(node, f'/metrics?{urlencode({"target": target})}')
+                except Exception as exc:
+                    raise KeyError(target) from exc
+                if response.status_code != 200:
+                    raise KeyError(target)
+                return split_families(response.content)
+        return self.cache[target].families
+
+    def forward(self, node):
+        if self.redirect:
+            self.send_response(307)
+            self.send_header('Location', f'http://{node}{self.path}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        try:
+            response = self.cluster.proxy(node, self.path, self.headers.get('If-None-Match'),
+                                          self.headers.get('Accept-Encoding', 'identity'))
+        except Exception as exc:
+            self.send_error(502, f'failed to reach owner {node}: {exc}')
+            return
+
+        if response.status_code == 304:
+            self.send_response(304)
+            self.send_header('ETag', response.headers.get('ETag', ''))
+            self.end_headers()
+            return
+        self.send_payload(response.content, response.headers.get('Content-Type', CONTENT_TYPE_LATEST), response.status_code,
+                          response.headers.get('ETag'))
 
 
 def main():
     ap = ArgumentParser(prog='bbb-selenium-exporter')
     ap.add_argument('--bind', '-b', help='bind to address:port', default='localhost:9123')
     ap.add_argument('--config', '-c', help='config file with BBB instances to scrape', default='/etc/bbb-selenium-exporter/targets')
+    ap.add_argument('--config-watch-interval', help='interval between checks of the config file for changes in seconds', type=float, default=WATCH_INTERVAL)
     ap.add_argument('--interval', '-i', help='interval between scrapes of the same host in seconds', type=int, default=900)
+    ap.add_argument('--retry-interval', help='interval between scrapes of an unreachable host in seconds', type=int, default=120)
+    ap.add_argument('--schedule', help='profiles successive probes of a host cycle through unless configured per host, e.g. light*3,full',
+                    default=DEFAULT_SCHEDULE)
     ap.add_argument('--jobs', '-j', help='number of parallel webdriver instances', type=int, default=len(os.sched_getaffinity(0)))
+    ap.add_argument('--api-timeout', help='timeout of BBB API calls in seconds', type=float, default=API_TIMEOUT)
+    ap.add_argument('--api-retries', help='number of retries of BBB API calls failing to connect', type=int, default=API_RETRIES)
+    ap.add_argument('--api-interval', help='interval between API-only probes of the same host in seconds, 0 to disable', type=int, default=0)
+    ap.add_argument('--api-concurrency', help='number of parallel API-only probes', type=int, default=64)
     ap.add_argument('--gui', help='disable headless mode for webdriver', action='store_true')
+    ap.add_argument('--pixel-check', help='how to verify video and presentation pixels', choices=PIXEL_MODES, default='canvas')
+    ap.add_argument('--wait-mode', help='how to wait for page elements', choices=WAIT_MODES, default='observer')
+    ap.add_argument('--launch-profile', help='how to launch browsers, dense trading fidelity for more browsers per machine',
+                    choices=LAUNCH_PROFILES, default='default')
+    ap.add_argument('--browser-template', help='browser user data directory copied for every browser session')
+    ap.add_argument('--browser-cache-dir', help='directory holding the disk caches of all browser sessions, e.g. on a tmpfs')
+    ap.add_argument('--parallel-scenarios', help='run independent scenarios concurrently in separate browser sessions', action='store_true')
+    ap.add_argument('--pool-size', help='number of pre-launched browser sessions per job', type=int, default=1)
+    ap.add_argument('--max-session-uses', help='recycle a browser session after this many probes', type=int, default=20)
+    ap.add_argument('--max-session-memory', help='recycle a browser session above this resident memory in MiB', type=int, default=1024)
+    ap.add_argument('--live-meetings', help='number of meetings per job kept alive between probes, which then only re-verify them',
+                    type=int, default=0)
+    ap.add_argument('--live-meeting-max-age', help='rebuild a meeting kept alive after this many seconds', type=int, default=3600)
+    ap.add_argument('--timeout-factor', help='limit the steps of probes to this many times their recent duration on the host, 0 to disable',
+                    type=float, default=3)
+    ap.add_argument('--probe-deadline', help='kill a worker whose probe takes longer than this many seconds, 0 to disable', type=int, default=300)
+    ap.add_argument('--max-worker-memory', help='kill a worker whose processes use more resident memory in MiB, 0 to disable', type=int, default=4096)
+    ap.add_argument('--cluster-node', help='address:port other cluster nodes reach this node at, defaults to --bind')
+    ap.add_argument('--cluster-peer', help='address:port of another cluster node sharing the targets', action='append', default=[])
+    ap.add_argument('--cluster-redirect', help='redirect scrapes of targets owned by other nodes instead of proxying', action='store_true')
+    ap.add_argument('--history-buckets', help='comma separated upper bounds of the scenario duration histogram buckets in seconds',
+                    type=lambda value: [float(bound) for bound in value.split(',')], default=BUCKETS)
+    ap.add_argument('--snapshot', help='file to persist results in across restarts')
+    ap.add_argument('--trace-probes', help='keep a timeline of the last probe of every host at /debug/probe?target=HOST', action='store_true')
+    ap.add_argument('--profile-probes', help='sample the stacks of probes, served at /debug/profile?target=HOST', action='store_true')
+    ap.add_argument('--dry-run', help='report fake results instead of starting browsers', action='store_true')
     args = ap.parse_args()
 
-    cache = ExecutionCache(prepare_selenium_test(not args.gui), args.jobs, Scheduler.factory(args.interval))
+    worker = SeleniumWorker.factory(args.parallel_scenarios, args.pool_size, args.max_session_uses, args.max_session_memory * 1024 * 1024,
+                                    {'timeout': args.api_timeout, 'retries': args.api_retries},
+                                    dry_run=args.dry_run, trace=args.trace_probes, profile=args.profile_probes,
+                                    live_meetings=args.live_meetings, live_max_age=args.live_meeting_max_age,
+                                    timeout_factor=args.timeout_factor,
+                                    headless=not args.gui, pixel_mode=args.pixel_check, wait_mode=args.wait_mode,
+                                    launch_profile=args.launch_profile, browser_template=args.browser_template,
+                                    browser_cache_dir=args.browser_cache_dir)
+    cache = ExecutionCache(worker, args.jobs, Scheduler.factory(args.interval, args.retry_interval),
+                           WorkerPool.factory(args.probe_deadline, args.max_worker_memory * 1024 * 1024), args.snapshot,
+                           History(args.history_buckets))
+
+    api_prober = None
+    if args.api_interval:
+        api_prober = ApiProber(args.api_interval, args.api_concurrency, lambda host, payload: cache.publish(host, 'api', payload),
+                               {'timeout': args.api_timeout, 'retries': args.api_retries})
+
+    def update_targets(targets):
+        targets = list(targets)
+        cache.update_targets(targets)
+        if api_prober:
+            api_prober.update_targets(targets)
 
     bindhost, _, bindport = args.bind.rpartition(":")
     print(f'Start listening on http://{bindhost}:{bindport}')
-    Thread(target=lambda: HTTPServer((bindhost, int(bindport)), CacheHandler.factory(cache)).serve_forever(), daemon=True).start()
+    handler = CacheHandler.factory(cache, redirect=args.cluster_redirect)
+    Thread(target=lambda: ThreadingHTTPServer((bindhost, int(bindport)), handler).serve_forever(), daemon=True).start()
 
-    def reload_targets(*_):
-        cache.update_targets(read_config(args.config))
+    cluster = None
+    if args.cluster_peer:
+        # the other nodes need to reach our health check while we look for them
+        cluster = Cluster(args.cluster_node or args.bind, args.cluster_peer, update_targets)
+        handler.cluster = cluster
 
-    reload_targets()
+    watcher = ConfigWatcher(args.config, cluster.update_targets if cluster else update_targets, args.config_watch_interval,
+                            args.schedule)
+    watcher.start()
 
     def shutdown(*_):
         print('got SIGTERM, shutting down')
+        watcher.stop()
+        if cluster:
+            cluster.stop()
+        if api_prober:
+            api_prober.stop()
         cache.teardown()
         print("cache teardown done")
         sys.exit(0)
 
-    signal.signal(signal.SIGHUP, reload_targets)
+    signal.signal(signal.SIGHUP, lambda *_: watcher.reload())
     signal.signal(signal.SIGTERM, shutdown)
 
     while True:
@@ -0,0 +1,133 @@
+"""Timing spans around the steps of a probe.
+
+Every span is observed in the probe_step_duration_seconds histogram of the
+exporter. While a trace is being recorded, the spans of all threads are also
+collected into a timeline of the probe, and the stacks of all threads can be
+sampled to find out where a probe spends its time.
+"""
+
+import functools
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, current_thread, get_ident
+
+from . import telemetry
+
+
+PROFILE_INTERVAL = 0.01
+
+STEP_DURATION = telemetry.histogram('probe_step_duration_seconds', 'Duration of the steps of probes', ['step'],
+                                    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60, float('inf')))
+
+_lock = Lock()
+_trace = None
+
+
+def _reset_after_fork():
+    # Workers are forked from the exporter while its other threads may hold
+    # the lock, which would then stay locked in the worker for good.
+    global _lock, _trace
+    _lock = Lock()
+    _trace = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        duration = time.perf_counter() - start
+        STEP_DURATION.labels(name).observe(duration)
+        with _lock:
+            if _trace is not None:
+                _trace.add(name, start, duration, ok)
+
+
+def traced(func):
+    """Run every call of a function in a span named after it."""
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return inner
+
+
+class Trace():
+    """The timeline of a probe and, if profiling, the sampled stacks of its threads."""
+
+    def __init__(self, profile=False):
+        self.started = time.time()
+        self.duration = None
+        self.spans = []
+        self.stacks = Counter() if profile else None
+        self._origin = time.perf_counter()
+        self._stopped = Event()
+        self._sampler = Thread(target=self._sample, daemon=True) if profile else None
+
+    def add(self, name, start, duration, ok):
+        self.spans.append({
+            'name': name,
+            'thread': current_thread().name,
+            'start': start - self._origin,
+            'duration': duration,
+            'ok': ok,
+        })
+
+    def start(self):
+        if self._sampler:
+            self._sampler.start()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self._origin
+        if self._sampler:
+            self._stopped.set()
+            self._sampler.join()
+
+    def _sample(self):
+        me = get_ident()
+        while not self._stopped.wait(PROFILE_INTERVAL):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def profile(self):
+        """The sampled stacks in the collapsed format understood by flame graph tools."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def to_dict(self):
+        return {
+            'started': self.started,
+            'duration': self.duration,
+            'spans': sorted(self.spans, key=lambda item: item['start']),
+            'profile': self.profile() if self.stacks is not None else None,
+        }
+
+
+@contextmanager
+def recording(profile=False):
+    """Record a trace of everything happening in this process meanwhile."""
+    global _trace
+    trace = Trace(profile)
+    with _lock:
+        _trace = trace
+    trace.start()
+    try:
+        yield trace
+    finally:
+        with _lock:
+            _trace = None
+        trace.stop()
@@ -0,0 +1,267 @@
+"""A supervised pool of worker processes running the probes.
+
+Every worker is a forked process leading a session of its own, which also
+holds the chromedriver and browser processes it starts. A watchdog kills the
+whole process group of a worker whose probe overruns its deadline or whose
+processes exceed the memory limit, reports the probe as failed and starts a
+new worker in its place. Processes left behind by dead workers are reaped.
+"""
+
+import ctypes
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from multiprocessing.connection import wait
+from queue import Queue
+from threading import Lock, Thread
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from . import proc
+
+
+WATCHDOG_INTERVAL = 1
+PR_SET_CHILD_SUBREAPER = 36
+
+WORKER_QUEUE_WAIT = Histogram('worker_queue_wait_seconds', 'Time tasks waited for an idle worker',
+                              buckets=(0.001, 0.01, 0.1, 1, 10, 60, float('inf')))
+WORKER_PROBES_IN_FLIGHT = Gauge('worker_probes_in_flight', 'Probes currently running in a worker process')
+WORKER_KILLS = Counter('worker_kills_total', 'Worker processes killed by the watchdog', ['reason'])
+WORKER_RESPAWNS = Counter('worker_respawns_total', 'Worker processes started to replace a dead one')
+WORKER_RSS = Gauge('worker_rss_bytes', 'Resident memory of a worker and all its browser processes', ['worker'])
+WORKER_ORPHANS_REAPED = Counter('worker_orphans_reaped_total', 'Processes left behind by dead workers that were killed and reaped')
+
+
+def _become_subreaper():
+    # Orphaned browser processes are then re-parented to us instead of init,
+    # so we can find and reap them.
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _work(worker_class, conn):
+    os.setsid()
+    for signum in (signal.SIGHUP, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    # Every message tells whether it is the result of the task or progress
+    # reported meanwhile, possibly from several threads of the task.
+    lock = Lock()
+
+    def send(done, message):
+        with lock:
+            conn.send((done, message))
+
+    worker = worker_class()
+    worker.report = lambda progress: send(False, progress)
+    worker.doInit()
+    while True:
+        task = conn.recv()
+        result = worker.doTask(task)
+        if task is None:
+            return
+        send(True, result)
+        # work left for after the result, e.g. launching browsers for the next task
+        worker.doAfterTask()
+
+
+class _Worker():
+    def __init__(self, context, worker_class, num):
+        self.num = num
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_work, args=(worker_class, child_conn), name=f'worker-{num}', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+
+class WorkerPool():
+    """Runs tasks in jobs worker processes, each an instance of worker_class.
+
+    A worker gets doInit() once, doTask(task) for every task and
+    doAfterTask() once the result of a task was sent.
+
+    Tasks are handed in with put() and their results come out of results()
+    in the order they finish. A put(None) lets the workers finish their
+    current task and stop, after which results() ends.
+    A task whose worker died gives the result of worker_class.failed(task, reason),
+    the reason being deadline, memory or died.
+    Whatever a task passes to self.report() meanwhile comes out of results()
+    as well, before its result.
+    A worker may hold on to something for later tasks, whose
+    worker_class.affinity(task) are listed by worker_class.pinned(result)
+    for every result. Those tasks go to that worker, waiting while it is
+    busy and letting other tasks pass meanwhile, until a later result of the
+    worker no longer lists them or forget(task) is called. Others go to any
+    idle worker.
+    """
+
+    def __init__(self, worker_class, jobs):
+        self.worker_class = worker_class
+        self._context = multiprocessing.get_context('fork')
+        self._subreaper = _become_subreaper()
+        self._pending = deque()
+        self._affinity = dict()
+        self._results = Queue()
+        self._lock = Lock()
+        self._stopping = False
+        self._workers = {num: _Worker(self._context, worker_class, num) for num in range(jobs)}
+        self._thread = Thread(target=self._supervise, daemon=True)
+        self._thread.start()
+
+    def put(self, task):
+        with self._lock:
+            if task is None:
+                self._stopping = True
+                for worker in self._workers.values():
+                    self._send(worker, None)
+                return
+            self._pending.append((task, time.monotonic()))
+            self._dispatch()
+
+    def forget(self, task):
+        """Let tasks like this one go to any worker again, e.g. as its target was removed."""
+        with self._lock:
+            self._affinity.pop(self.worker_class.affinity(task), None)
+
+    def results(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            yield result
+
+    def _send(self, worker, task):
+        try:
+            worker.conn.send(task)
+        except OSError:
+            # the worker died, which the supervisor will notice
+            pass
+
+    def _dispatch(self):
+        idle = {num: worker for num, worker in self._workers.items() if worker.task is None}
+        waiting = []
+        while self._pending and idle:
+            task, queued = self._pending.popleft()
+            num = self._affinity.get(self.worker_class.affinity(task))
+            if num is not None and num not in idle:
+                waiting.append((task, queued))
+                continue
+            worker = idle.pop(num, None) or idle.pop(next(iter(idle)))
+            worker.task = task
+            worker.started = time.monotonic()
+            WORKER_QUEUE_WAIT.observe(worker.started - queued)
+            self._send(worker, worker.task)
+        self._pending.extendleft(reversed(waiting))
+        WORKER_PROBES_IN_FLIGHT.set(sum(1 for worker in self._workers.values() if worker.task is not None))
+
+    def _supervise(self):
+        while True:
+            with self._lock:
+                workers = list(self._workers.values())
+            if not workers:
+                break
+            ready = wait([worker.conn for worker in workers], WATCHDOG_INTERVAL)
+            with self._lock:
+                for worker in workers:
+                    if worker.conn in ready:
+                        self._receive(worker)
+                self._watchdog()
+                self._reap_orphans()
+                self._dispatch()
+        self._results.put(None)
+
+    def _receive(self, worker):
+        try:
+            done, message = worker.conn.recv()
+        except (EOFError, OSError):
+            worker.process.join(WATCHDOG_INTERVAL)
+            self._replace(worker)
+            return
+        if done:
+            worker.task = None
+            self._pin(worker, self.worker_class.pinned(message))
+        self._results.put(message)
+
+    def _pin(self, worker, keys):
+        keys = set(keys)
+        for key, num in list(self._affinity.items()):
+            if num == worker.num and key not in keys:
+                del self._affinity[key]
+        for key in keys:
+            self._affinity[key] = worker.num
+
+    def _watchdog(self):
+        now = time.monotonic()
+        children = proc.children()
+        for worker in list(self._workers.values()):
+            if not worker.process.is_alive():
+                self._replace(worker)
+                continue
+            rss = proc.tree_rss(worker.process.pid, children)
+            WORKER_RSS.labels(str(worker.num)).set(rss)
+            if worker.task is not None and self.deadline and now - worker.started > self.deadline:
+                self._replace(worker, 'deadline')
+            elif self.max_rss and rss > self.max_rss:
+                self._replace(worker, 'memory')
+
+    def _replace(self, worker, reason=None):
+        """Kill a worker with all its processes and start a new one unless stopping."""
+        if reason:
+            WORKER_KILLS.labels(reason).inc()
+            print(f'killing worker {worker.num} ({reason}) while probing {worker.task.host if worker.task else "nothing"}')
+        _kill_group(worker.process.pid)
+        worker.process.join()
+        try:
+            while reason is None and worker.task is not None and worker.conn.poll():
+                # the result might have arrived just before the worker exited
+                done, message = worker.conn.recv()
+                self._results.put(message)
+                if done:
+                    worker.task = None
+        except (EOFError, OSError):
+            pass
+        worker.conn.close()
+        # whatever the worker held on to is gone with it
+        self._pin(worker, ())
+        if worker.task is not None:
+            self._results.put(self.worker_class.failed(worker.task, reason or 'died'))
+        del self._workers[worker.num]
+        if self._stopping:
+            return
+        if reason is None:
+            print(f'worker {worker.num} died with exit code {worker.process.exitcode}')
+        WORKER_RESPAWNS.inc()
+        self._workers[worker.num] = _Worker(self._context, self.worker_class, worker.num)
+
+    def _reap_orphans(self):
+        if not self._subreaper:
+            return
+        me = os.getpid()
+        session = os.getsid(0)
+        workers = {worker.process.pid for worker in self._workers.values()}
+        for pid in proc.children().get(me, []):
+            try:
+                if pid in workers or proc.stat(pid)[1] == session:
+                    continue
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (OSError, ValueError, IndexError):
+                continue
+            WORKER_ORPHANS_REAPED.inc()
+
+    @staticmethod
+    def factory(deadline, max_rss):
+        return type('WorkerPool', (WorkerPool, object), {'deadline': deadline, 'max_rss': max_rss})
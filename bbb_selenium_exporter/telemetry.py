@@ -0,0 +1,104 @@
+"""Exporter metrics that may be updated from the worker processes.
+
+The probes run in worker processes, whose metrics would never show up on
+the exporter's own /metrics. Metrics created here are defined in every
+process; inside a worker their updates are buffered, shipped along with the
+probe result and applied to the same metric in the exporter process.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+_metrics = dict()
+_buffer = []
+_lock = Lock()
+_buffering = False
+
+
+def _reset_after_fork():
+    # Workers are forked from the exporter while its other threads may hold
+    # the lock, see spans.
+    global _buffer, _lock
+    _buffer = []
+    _lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def start_buffering():
+    """Buffer all updates made in this process until they are drained."""
+    global _buffering
+    _buffering = True
+
+
+def drain():
+    global _buffer
+    with _lock:
+        updates, _buffer = _buffer, []
+    return updates
+
+
+def apply(updates):
+    for name, labelvalues, method, amount in updates:
+        _metrics[name]._update(labelvalues, method, amount)
+
+
+class _Metric():
+    def __init__(self, metric, name, labelvalues=()):
+        self._metric = metric
+        self._name = name
+        self._labelvalues = tuple(labelvalues)
+
+    def labels(self, *labelvalues):
+        return _Metric(self._metric, self._name, labelvalues)
+
+    def _update(self, labelvalues, method, amount):
+        metric = self._metric.labels(*labelvalues) if labelvalues else self._metric
+        getattr(metric, method)(amount)
+
+    def _record(self, method, amount):
+        if _buffering:
+            with _lock:
+                _buffer.append((self._name, self._labelvalues, method, amount))
+        else:
+            self._update(self._labelvalues, method, amount)
+
+    def inc(self, amount=1):
+        self._record('inc', amount)
+
+    def set(self, value):
+        self._record('set', value)
+
+    def observe(self, amount):
+        self._record('observe', amount)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+def _register(metric_class, name, *args, **kwargs):
+    _metrics[name] = _Metric(metric_class(name, *args, **kwargs), name)
+    return _metrics[name]
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
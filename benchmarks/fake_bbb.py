@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""A local stand-in for a BigBlueButton server.
+
+Answers the create, end, join, isMeetingRunning and getMeetings API calls,
+validating their checksums like a real server, and serves a page mimicking
+the parts of the HTML5 client the probes interact with. Every request can be
+delayed by a random latency and API calls as well as the requests of the
+page can be made to fail.
+
+The server speaks plain HTTP, so the API client of the exporter has to be
+told to use the scheme http, which benchmarks.probes takes care of. Any
+address of the loopback network reaches it, e.g. 127.0.0.2:PORT, so several
+targets can share one fake server.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from hashlib import sha1
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from PIL import Image
+
+
+CLIENT_PAGE = os.path.join(os.path.dirname(__file__), 'fake_client.html')
+PAD_DEPTH = 3
+
+# The shared notes are nested three iframes deep like Etherpad in BBB. The
+# line is only created once it has its text, so it is never seen empty.
+PAD_PAGE = '''<!DOCTYPE html>
+<html><body><script>
+const meetingID = {meeting_id};
+const key = `pad-${{meetingID}}`;
+const line = document.createElement('div');
+line.className = 'ace-line';
+line.contentEditable = 'true';
+line.textContent = localStorage.getItem(key) || {text};
+line.oninput = () => {{
+    localStorage.setItem(key, line.innerText);
+    fetch(`event?meetingID=${{encodeURIComponent(meetingID)}}`, {{method: 'POST', body: JSON.stringify({{type: 'pad', value: line.innerText}})}});
+}};
+document.body.appendChild(line);
+</script></body></html>
+'''
+PAD_FRAME = '<!DOCTYPE html>\n<html><body><iframe src="pad?{query}"></iframe></body></html>\n'
+
+
+def script_literal(value):
+    return json.dumps(value).replace('</', '<\\/')
+
+
+def png(color):
+    buffer = BytesIO()
+    Image.new('RGB', (320, 180), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+SLIDES = {'white': png((255, 255, 255)), 'red': png((230, 0, 0))}
+
+
+class FakeMeeting():
+    def __init__(self, moderator_pw):
+        self.moderator_pw = moderator_pw
+        self.chat = []
+        self.poll = False
+        self.video = False
+        self.pad = ''
+        self.converted = None
+
+    def state(self):
+        return {
+            'chat': self.chat,
+            'poll': self.poll,
+            'video': self.video,
+            'presentation': self.converted is not None and time.monotonic() >= self.converted,
+        }
+
+
+class FakeBBB():
+    """A fake BBB server listening on all loopback addresses at port, 0 picking a free one.
+
+    Requests are delayed by a random latency averaging latency seconds, API
+    calls fail with a probability of failure_rate and uploaded presentations
+    take conversion seconds to appear.
+    """
+
+    def __init__(self, secret, port=0, latency=0, failure_rate=0, conversion=1):
+        self.secret = secret
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.conversion = conversion
+        self.meetings = dict()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        handler = type('FakeBBBHandler', (FakeBBBHandler, object), {'bbb': self})
+        self.server = ThreadingHTTPServer(('', port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def delay(self):
+        if self.latency:
+            time.sleep(random.expovariate(1 / self.latency))
+
+    def fails(self):
+        return random.random() < self.failure_rate
+
+    def api(self, method, params):
+        """Run an API call, returning the HTTP status, headers and XML body."""
+        if method == 'create':
+            with self.lock:
+                self.meetings.setdefault(params['meetingID'], FakeMeeting(params.get('moderatorPW', '')))
+            return self.success(f'<meetingID>{escape(params["meetingID"])}</meetingID>')
+        if method == 'getMeetings':
+            return self.success('<meetings/>')
+
+        meeting = self.meetings.get(params.get('meetingID'))
+        if method == 'isMeetingRunning':
+            return self.success(f'<running>{"true" if meeting else "false"}</running>')
+        if meeting is None:
+            return self.failure('notFound', 'A meeting with that ID does not exist')
+        if method in ('end', 'join') and params.get('password') != meeting.moderator_pw:
+            return self.failure('invalidPassword', 'You must supply the moderator password for this call.')
+        if method == 'end':
+            with self.lock:
+                del self.meetings[params['meetingID']]
+            return self.success('')
+        if method == 'join':
+            location = f'/html5client/join?{urlencode({"meetingID": params["meetingID"], "fullName": params.get("fullName", "")})}'
+            return 302, {'Location': location}, b''
+        return self.failure('unsupportedRequest', 'This request is not supported.')
+
+    def success(self, body):
+        return 200, {'Content-Type': 'text/xml'}, f'<response><returncode>SUCCESS</returncode>{body}</response>'.encode()
+
+    def failure(self, key, message):
+        return 200, {'Content-Type': 'text/xml'}, (f'<response><returncode>FAILED</returncode><messageKey>{key}</messageKey>'
+                                                   f'<message>{escape(message)}</message></response>').encode()
+
+    def checksum_valid(self, method, query):
+        params, _, checksum = query.rpartition('checksum=')
+        return sha1(f'{method}{params.rstrip("&")}{self.secret}'.encode()).hexdigest() == checksum
+
+
+class FakeBBBHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.bbb.delay()
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        meeting = self.bbb.meetings.get(params.get('meetingID'))
+
+        if url.path.startswith('/bigbluebutton/api/'):
+            method = url.path.rpartition('/')[2]
+            with self.bbb.lock:
+                self.bbb.calls[method] += 1
+            if not self.bbb.checksum_valid(method, url.query):
+                self.respond(*self.bbb.failure('checksumError', 'You did not pass the checksum security check'))
+            elif self.bbb.fails():
+                self.respond(*self.bbb.failure('fakeFailure', 'The fake server was told to fail'))
+            else:
+                self.respond(*self.bbb.api(method, params))
+        elif url.path in ('/html5client/', '/html5client/join'):
+            with open(CLIENT_PAGE, 'rb') as page:
+                self.respond(200, {'Content-Type': 'text/html; charset=utf-8'}, page.read())
+        elif url.path == '/html5client/slide.png' and params.get('color') in SLIDES:
+            self.respond(200, {'Content-Type': 'image/png'}, SLIDES[params['color']])
+        elif url.path == '/html5client/state' and meeting:
+            with self.bbb.lock:
+                state = meeting.state()
+            self.respond(200, {'Content-Type': 'application/json'}, json.dumps(state).encode())
+        elif url.path == '/html5client/pad' and meeting:
+            depth = int(params.get('depth', 1))
+            if depth < PAD_DEPTH:
+                page = PAD_FRAME.format(query=escape(urlencode({'depth': depth + 1, 'meetingID': params['meetingID']})))
+            else:
+                page = PAD_PAGE.format(meeting_id=script_literal(params['meetingID']), text=script_literal(meeting.pad))
+            self.respond(200, {'Content-Type': 'text/html; charset=utf-8'}, page.encode())
+        else:
+            self.respond(404, {'Content-Type': 'text/plain'}, b'not found')
+
+    def do_POST(self):
+        self.bbb.delay()
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        meeting = self.bbb.meetings.get(params.get('meetingID'))
+
+        if meeting is None:
+            self.respond(404, {'Content-Type': 'text/plain'}, b'no such meeting')
+            return
+        if self.bbb.fails():
+            self.respond(500, {'Content-Type': 'text/plain'}, b'the fake server was told to fail')
+            return
+
+        with self.bbb.lock:
+            if url.path == '/html5client/upload':
+                meeting.converted = time.monotonic() + self.bbb.conversion
+            elif url.path == '/html5client/event':
+                event = json.loads(body)
+                if event['type'] == 'chat':
+                    meeting.chat.append(event['value'])
+                elif event['type'] == 'pad':
+                    meeting.pad = event['value']
+                elif event['type'] in ('poll', 'video'):
+                    setattr(meeting, event['type'], True)
+            elif url.path != '/html5client/echo':
+                self.respond(404, {'Content-Type': 'text/plain'}, b'not found')
+                return
+        self.respond(204, {}, b'')
+
+    def respond(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--port', type=int, default=8090, help='port to listen at')
+    ap.add_argument('--secret', default='fake-secret', help='API secret')
+    ap.add_argument('--latency', type=float, default=0, help='mean latency of every request in seconds')
+    ap.add_argument('--failure-rate', type=float, default=0, help='share of API calls and client requests failing')
+    ap.add_argument('--conversion', type=float, default=1, help='seconds it takes to convert a presentation')
+    args = ap.parse_args()
+
+    bbb = FakeBBB(args.secret, args.port, args.latency, args.failure_rate, args.conversion)
+    print(f'fake BBB server listening on http://127.0.0.1:{bbb.port} with secret {args.secret}')
+    bbb.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Compare the scrape throughput and latency of the HTTP serving layers.
+
+The "legacy" variant is the handler the exporter used to have, serving the
+plain payloads from a single-threaded HTTPServer speaking HTTP/1.0. The
+"threading" variant is the current CacheHandler, with keep-alive, gzip and
+ETags, on a ThreadingHTTPServer. Use --stalled to add clients that open a
+connection and never finish their request.
+"""
+
+import random
+import socket
+import statistics
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, generate_latest
+
+from bbb_selenium_exporter.server import CacheEntry, CacheHandler
+
+
+SCENARIOS = ['connect_server', 'echo_test', 'join_headphone', 'start_cam',
+             'upload_pres', 'chat_test', 'poll_test', 'etherpad_test']
+
+
+def fake_result(host):
+    registry = CollectorRegistry()
+    for slug in SCENARIOS:
+        Gauge(f'{slug}_success', f'Success of {slug}', ['backend'], registry=registry).labels(host).set(1)
+        Gauge(f'{slug}_duration_seconds', f'Duration of {slug}', ['backend'], registry=registry).labels(host).set(random.random())
+    return generate_latest(registry)
+
+
+class LegacyHandler(BaseHTTPRequestHandler):
+    """The handler of the exporter before the serving layer was replaced."""
+
+    def do_GET(self):
+        if not self.path.startswith('/metrics'):
+            self.send_error(404)
+            return
+
+        try:
+            target = parse_qs(urlparse(self.path).query)['target'][0]
+        except KeyError:
+            self.send_error(400, 'query parameter "target" is missing')
+            return
+
+        try:
+            result = self.cache[target].identity
+        except KeyError:
+            self.send_error(404, 'unknown target')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.end_headers()
+        self.wfile.write(result)
+
+
+def start_server(variant, cache):
+    if variant == 'legacy':
+        server = HTTPServer(('localhost', 0), type('LegacyHandler', (LegacyHandler, object), {'cache': cache}))
+    else:
+        server = ThreadingHTTPServer(('localhost', 0), CacheHandler.factory(cache))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stall(port, stalled):
+    sockets = []
+    for _ in range(stalled):
+        sock = socket.create_connection(('localhost', port))
+        sock.sendall(b'GET /metrics?target=')
+        sockets.append(sock)
+    return sockets
+
+
+def scrape(port, hosts, deadline, latencies, errors):
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip'
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            session.get(f'http://localhost:{port}/metrics?target={random.choice(hosts)}', timeout=5).raise_for_status()
+        except requests.exceptions.RequestException:
+            errors.append(1)
+            continue
+        latencies.append(time.monotonic() - start)
+
+
+def run(variant, cache, scrapers, duration, stalled):
+    server = start_server(variant, cache)
+    port = server.server_address[1]
+    sockets = stall(port, stalled)
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=scrape, args=(port, list(cache), deadline, latencies, errors)) for _ in range(scrapers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for sock in sockets:
+        sock.close()
+    server.shutdown()
+
+    if not latencies:
+        return f'{variant:10} no successful scrapes, {len(errors)} errors'
+    p99 = statistics.quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+    return (f'{variant:10} {len(latencies) / duration:9.1f} req/s  '
+            f'p50 {statistics.median(latencies) * 1000:7.2f} ms  p99 {p99 * 1000:7.2f} ms  {len(errors)} errors')
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--targets', type=int, default=150, help='number of cached targets')
+    ap.add_argument('--scrapers', type=int, default=16, help='number of concurrent scrapers')
+    ap.add_argument('--duration', type=float, default=10, help='seconds to run each variant')
+    ap.add_argument('--stalled', type=int, default=0, help='number of clients stalling mid-request')
+    args = ap.parse_args()
+
+    cache = {f'bbb{num}.example.com': CacheEntry.create(num, time.time(), {'browser': fake_result(f'bbb{num}.example.com')})
+             for num in range(args.targets)}
+    for variant in ('legacy', 'threading'):
+        print(run(variant, cache, args.scrapers, args.duration, args.stalled))
+
+
+if __name__ == '__main__':
+    main()
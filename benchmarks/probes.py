@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Measure the exporter end to end against a local fake BBB server.
+
+For every --launch-profiles and --jobs value, the scheduler, worker pool
+and browser probes of the exporter run against benchmarks.fake_bbb for a
+while, with targets that are always due so the workers never idle. Reported
+are the probes per minute, the latency distribution of every scenario, the
+CPU time and resident memory of every browser and of all browsers per job,
+and the latency of scrapes served meanwhile.
+
+Needs Chrome and chromedriver, just like the exporter.
+"""
+
+import os
+import statistics
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer
+
+from bbb_selenium_exporter import proc
+from bbb_selenium_exporter.config import Target
+from bbb_selenium_exporter.history import History, scenario_results
+from bbb_selenium_exporter.server import CacheHandler, ExecutionCache, Scheduler, SeleniumWorker
+from bbb_selenium_exporter.supervisor import WorkerPool
+
+from .fake_bbb import FakeBBB
+from .http_server import scrape
+
+
+SAMPLE_INTERVAL = 0.5
+
+
+class Recorder(History):
+    """Keeps the scenario results of every probe besides aggregating them."""
+
+    def __init__(self):
+        super().__init__()
+        self.probes = []
+
+    def record(self, host, payload):
+        self.probes.append(scenario_results(payload))
+        return super().record(host, payload)
+
+
+class BrowserSampler():
+    """Samples the resident memory and CPU time of the browsers started by this process.
+
+    Every chromedriver process and its descendants count as one browser.
+    """
+
+    def __init__(self):
+        self.rss = []
+        # resident memory of all browsers together
+        self.total_rss = []
+        self.cpu = dict()
+        self.browsers = set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            children = proc.children()
+            pending = list(children.get(os.getpid(), []))
+            total = 0
+            while pending:
+                pid = pending.pop()
+                try:
+                    if proc.name(pid) == 'chromedriver':
+                        self.browsers.add(pid)
+                        rss = proc.tree_rss(pid, children)
+                        self.rss.append(rss)
+                        total += rss
+                        self._sample_cpu(pid, children)
+                        continue
+                except OSError:
+                    continue
+                pending.extend(children.get(pid, []))
+            if total:
+                self.total_rss.append(total)
+
+    def _sample_cpu(self, root, children):
+        pending = [root]
+        while pending:
+            pid = pending.pop()
+            pending.extend(children.get(pid, []))
+            try:
+                # processes are gone before their last sample, so their CPU time is a lower bound
+                self.cpu[pid] = max(self.cpu.get(pid, 0), proc.cpu_seconds(pid))
+            except (OSError, ValueError, IndexError):
+                continue
+
+
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else float('nan')
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def run(jobs, launch_profile, bbb, args):
+    targets = [Target(f'127.0.0.{num + 2}:{bbb.port}', bbb.secret) for num in range(args.targets)]
+    worker = SeleniumWorker.factory(args.parallel_scenarios, 1, 20, None, {'scheme': 'http', 'timeout': 5, 'retries': 0},
+                                    headless=not args.gui, launch_profile=launch_profile)
+    recorder = Recorder()
+    # an interval of a second keeps every target due, so the workers are always busy
+    cache = ExecutionCache(worker, jobs, Scheduler.factory(1, 1), WorkerPool.factory(300, 0), history=recorder)
+    handler = type('QuietHandler', (CacheHandler.factory(cache), object), {'log_message': lambda *args: None})
+    server = ThreadingHTTPServer(('localhost', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sampler = BrowserSampler()
+    sampler.start()
+
+    deadline = time.monotonic() + args.duration
+    cache.update_targets(targets)
+    # scrapes of targets without a result yet would only count as errors
+    while len(recorder.probes) < len(targets) and time.monotonic() < deadline:
+        time.sleep(SAMPLE_INTERVAL)
+    scrape_start = time.monotonic()
+    latencies, errors = [], []
+    scrapers = [threading.Thread(target=scrape, args=(server.server_address[1], [target.host for target in targets], deadline, latencies, errors))
+                for _ in range(args.scrapers)]
+    for thread in scrapers:
+        thread.start()
+    for thread in scrapers:
+        thread.join()
+    probes = list(recorder.probes)
+    cache.teardown()
+    sampler.stop()
+    server.shutdown()
+
+    failed = sum(1 for results in probes if any(result != 'success' for result, _ in results.values()))
+    print(f'{launch_profile} jobs {jobs}: {len(probes) / args.duration * 60:.1f} probes/min, {failed} of {len(probes)} probes failed')
+    print(f'  {"scenario":<16} {"runs":>5} {"fails":>5} {"p50 s":>7} {"p90 s":>7} {"max s":>7}')
+    for name in sorted({name for results in probes for name in results}):
+        runs = [results[name] for results in probes if name in results]
+        durations = [duration for result, duration in runs if result == 'success']
+        print(f'  {name:<16} {len(runs):>5} {len(runs) - len(durations):>5} {percentile(durations, 50):>7.2f} '
+              f'{percentile(durations, 90):>7.2f} {max(durations, default=float("nan")):>7.2f}')
+
+    browsers = len(sampler.browsers)
+    cpu = sum(sampler.cpu.values())
+    if browsers:
+        print(f'  browsers: {browsers}, rss p50 {percentile(sampler.rss, 50) / 2**20:.0f} MiB max {max(sampler.rss) / 2**20:.0f} MiB, '
+              f'cpu {cpu / browsers:.1f} s per browser, {cpu / max(len(probes), 1):.1f} s per probe')
+        print(f'  per job: rss p50 {percentile(sampler.total_rss, 50) / jobs / 2**20:.0f} MiB '
+              f'max {max(sampler.total_rss) / jobs / 2**20:.0f} MiB, cpu {cpu / args.duration / jobs:.2f} cores')
+    if latencies:
+        print(f'  scrapes: {len(latencies) / max(deadline - scrape_start, 1e-9):.1f} req/s p50 {statistics.median(latencies) * 1000:.2f} ms '
+              f'p99 {percentile(latencies, 99) * 1000:.2f} ms, {len(errors)} errors')
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--jobs', type=lambda value: [int(jobs) for jobs in value.split(',')], default=[1, 2, 4],
+                    help='comma separated numbers of jobs to compare')
+    ap.add_argument('--launch-profiles', type=lambda value: value.split(','), default=['default', 'dense'],
+                    help='comma separated browser launch profiles to compare')
+    ap.add_argument('--targets', type=int, default=8, help='number of targets, all served by the fake server')
+    ap.add_argument('--duration', type=float, default=120, help='seconds to run each number of jobs')
+    ap.add_argument('--scrapers', type=int, default=4, help='number of concurrent scrapers')
+    ap.add_argument('--latency', type=float, default=0.05, help='mean latency of every request to the fake server in seconds')
+    ap.add_argument('--failure-rate', type=float, default=0, help='share of requests to the fake server failing')
+    ap.add_argument('--conversion', type=float, default=1, help='seconds it takes the fake server to convert a presentation')
+    ap.add_argument('--parallel-scenarios', help='run independent scenarios concurrently in separate browser sessions', action='store_true')
+    ap.add_argument('--gui', help='disable headless mode for webdriver', action='store_true')
+    args = ap.parse_args()
+
+    bbb = FakeBBB('fake-secret', latency=args.latency, failure_rate=args.failure_rate, conversion=args.conversion).start()
+    for launch_profile in args.launch_profiles:
+        for jobs in args.jobs:
+            run(jobs, launch_profile, bbb, args)
+            print(f'  fake server calls: {", ".join(f"{method} {count}" for method, count in sorted(bbb.calls.items()))}')
+            bbb.calls.clear()
+    bbb.stop()
+
+
+if __name__ == '__main__':
+    main()
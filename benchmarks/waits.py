@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Compare the round trips and latency of the element wait modes.
+
+Replays the chains of waits of the probe scenarios against a blank page in
+which every awaited element appears (or an overlay disappears) after a random
+delay, as if the BBB client reacted to the previous step. For each wait mode
+the WebDriver commands issued while waiting are counted and the time between
+the page change and the end of the wait is reported as overhead.
+
+Needs Chrome and chromedriver, just like the exporter.
+"""
+
+import random
+import statistics
+from argparse import ArgumentParser
+
+from selenium.webdriver.common.by import By
+
+from bbb_selenium_exporter.collect import WAIT_MODES, BBBDriver
+
+
+# The waits of each scenario, a step with several conditions is one batched wait.
+SCENARIOS = {
+    'echo_test': [['clickable'], ['clickable']],
+    'start_cam': [['invisible', 'invisible'], ['clickable'], ['present'], ['present'], ['present']],
+    'upload_pres': [['clickable'], ['visible'], ['visible'], ['visible'], ['invisible']],
+    'chat_test': [['clickable'], ['clickable'], ['present']],
+    'poll_test': [['clickable'], ['visible'], ['present'], ['present']],
+    'etherpad_test': [['clickable'], ['present', 'present'], ['present'], ['present'], ['present'], ['present']],
+}
+
+# Adds the elements of a step after a delay. Awaited invisible elements are
+# added right away and removed after the delay.
+SCHEDULE_SCRIPT = '''
+const [ids, states, delay] = arguments;
+ids.forEach((id, i) => {
+    if (states[i] === 'invisible') {
+        const overlay = document.createElement('div');
+        overlay.id = id;
+        overlay.textContent = 'overlay';
+        document.body.appendChild(overlay);
+    }
+});
+setTimeout(() => {
+    window.changedAt = performance.now();
+    ids.forEach((id, i) => {
+        if (states[i] === 'invisible') {
+            document.getElementById(id).remove();
+        } else {
+            const button = document.createElement('button');
+            button.id = id;
+            button.textContent = id;
+            document.body.appendChild(button);
+        }
+    });
+}, delay * 1000);
+'''
+
+
+class CountingDriver():
+    """Counts the WebDriver commands sent by a driver."""
+
+    def __init__(self, driver):
+        self.commands = 0
+        self._execute = driver.execute
+        driver.execute = self.execute
+
+    def execute(self, *args, **kwargs):
+        self.commands += 1
+        return self._execute(*args, **kwargs)
+
+
+def run_scenario(conn, counter, steps, max_delay):
+    commands, overheads = 0, []
+    conn.driver.get('about:blank')
+    for num, states in enumerate(steps):
+        ids = [f'step-{num}-{i}' for i in range(len(states))]
+        conn.driver.execute_script(SCHEDULE_SCRIPT, ids, states, random.uniform(0, max_delay))
+        before = counter.commands
+        conn._wait_all(10, *[(state, (By.ID, id)) for id, state in zip(ids, states)])
+        commands += counter.commands - before
+        overheads.append(conn.driver.execute_script('return performance.now() - window.changedAt;') / 1000)
+    return commands, sum(overheads)
+
+
+def main():
+    ap = ArgumentParser(description=__doc__)
+    ap.add_argument('--rounds', help='number of runs of every scenario', type=int, default=5)
+    ap.add_argument('--max-delay', help='maximum delay of a page change in seconds', type=float, default=1.5)
+    ap.add_argument('--gui', help='disable headless mode for webdriver', action='store_true')
+    args = ap.parse_args()
+
+    print(f'{"scenario":<16} {"mode":<10} {"commands":>9} {"overhead ms":>12}')
+    for mode in WAIT_MODES:
+        with BBBDriver(headless=not args.gui, wait_mode=mode) as conn:
+            counter = CountingDriver(conn.driver)
+            for name, steps in SCENARIOS.items():
+                runs = [run_scenario(conn, counter, steps, args.max_delay) for _ in range(args.rounds)]
+                commands = statistics.mean(commands for commands, _ in runs)
+                overhead = statistics.mean(overhead for _, overhead in runs)
+                print(f'{name:<16} {mode:<10} {commands:>9.1f} {overhead * 1000:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,6 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://gitlab.com/infra.run/public/bbb-selenium-exporter",
     install_requires=[
-        "mpipe",
         "pillow",
         "prometheus-client",
         "requests",
@@ -21,7 +20,7 @@ setuptools.setup(
         "trio",
         "idna==2.10",
     ],
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     package_data={"": ["assets/*.pdf"]},
     include_package_data=True,
     entry_points={
@@ -36,5 +35,5 @@ setuptools.setup(
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
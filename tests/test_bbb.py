@@ -0,0 +1,123 @@
+import socket
+from time import sleep
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+from bbb_selenium_exporter import bbb
+from benchmarks.fake_bbb import FakeBBB
+
+
+SECRET = 'fake-secret'
+
+
+@pytest.fixture
+def server():
+    fake = FakeBBB(SECRET).start()
+    yield fake
+    fake.stop()
+    bbb.forget(f'127.0.0.1:{fake.port}')
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # the backoff shares the time module with the fake server, which keeps the real sleep
+    slept = []
+    monkeypatch.setattr(bbb.time, 'sleep', slept.append)
+    return slept
+
+
+def make_client(server, secret=SECRET, **options):
+    return bbb.Client(f'127.0.0.1:{server.port}', secret, scheme='http', **options)
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def retries(call):
+    return REGISTRY.get_sample_value('bbb_api_retries_total', {'call': call}) or 0
+
+
+def test_checksum_is_sha1_of_call_query_and_secret():
+    client = bbb.Client('bbb.example.org', 'secret')
+    assert client.checksum('create', {'meetingID': 'a b'}) == '77f16fd3c1d73eaf2718607c05b983df30247919'
+
+
+def test_call_is_accepted_by_server(server):
+    root = make_client(server).call('create', {'meetingID': 'room', 'moderatorPW': 'pw'})
+    assert root.findtext('meetingID') == 'room'
+    assert 'room' in server.meetings
+
+
+def test_wrong_secret_fails_checksum(server):
+    with pytest.raises(bbb.Error, match='checksumError'):
+        make_client(server, secret='wrong').call('getMeetings', {})
+
+
+def test_failed_response_raises_its_message(server):
+    with pytest.raises(bbb.Error, match='notFound: A meeting with that ID does not exist'):
+        make_client(server).call('end', {'meetingID': 'missing', 'password': 'pw'})
+
+
+def test_connection_errors_are_retried_with_backoff(sleeps):
+    client = bbb.Client(f'127.0.0.1:{closed_port()}', SECRET, scheme='http', retries=2, backoff=0.5)
+    before = retries('getMeetings')
+    with pytest.raises(bbb.Error, match='failed to talk to server'):
+        client.call('getMeetings', {})
+    assert sleeps == [0.5, 1.0]
+    assert retries('getMeetings') == before + 2
+
+
+def test_retry_recovers_once_server_answers(server, sleeps, monkeypatch):
+    client = make_client(server, retries=2)
+    get = client._session.get
+    attempts = []
+
+    def flaky_get(*args, **kwargs):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise requests.exceptions.ConnectionError('connection reset')
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(client._session, 'get', flaky_get)
+    assert client.call('getMeetings', {}).findtext('returncode') == 'SUCCESS'
+    assert len(attempts) == 2
+    assert len(sleeps) == 1
+
+
+def test_slow_server_times_out(server, sleeps):
+    server.delay = lambda: sleep(0.5)
+    before = retries('isMeetingRunning')
+    with pytest.raises(bbb.Error, match='failed to talk to server'):
+        make_client(server, timeout=0.05, retries=1).call('isMeetingRunning', {'meetingID': 'room'})
+    assert retries('isMeetingRunning') == before + 1
+
+
+def test_meeting_is_created_joined_and_ended(server):
+    hostname = f'127.0.0.1:{server.port}'
+    with bbb.Meeting(hostname, SECRET, name='room', scheme='http') as meeting:
+        assert 'room' in server.meetings
+        response = requests.get(meeting.join_url('probe'), allow_redirects=False)
+        assert response.status_code == 302
+        assert '/html5client/join' in response.headers['Location']
+    assert 'room' not in server.meetings
+    assert server.calls['create'] == server.calls['join'] == server.calls['end'] == 1
+
+
+def test_meeting_with_wrong_secret_is_not_created(server):
+    with pytest.raises(bbb.Error, match='checksumError'):
+        with bbb.Meeting(f'127.0.0.1:{server.port}', 'wrong', scheme='http'):
+            pass
+    assert not server.meetings
+
+
+def test_forget_drops_shared_clients():
+    shared = bbb.client('bbb.example.org', 'secret')
+    assert bbb.client('bbb.example.org', 'other') is shared
+    bbb.forget('bbb.example.org')
+    assert bbb.client('bbb.example.org', 'secret') is not shared
+    bbb.forget('bbb.example.org')